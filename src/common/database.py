@@ -1,6 +1,85 @@
 """Database setup and connection utilities"""
 import sqlite3
 import os
+from contextlib import contextmanager
+from datetime import date, datetime
+
+# Named PRAGMA tuning profiles applied when a connection is opened
+PRAGMA_PROFILES = {
+    'default': {},
+    # Full durability: every commit is fsynced, readers still never block writers
+    'safe': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'temp_store': 'DEFAULT',
+    },
+    # Nightly batch speed: a crash may lose the last commits but never corrupts the file
+    'bulk-load': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -262144,  # 256 MB (negative values are KiB)
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,
+    },
+}
+
+# Integer keys derived from TEXT date columns ({prefix}_day, _epoch, _week, _month),
+# per table: date column -> key prefix. Computed by SQLite when a row is written, so
+# stages filter, group and index on integers instead of parsing dates per row.
+DATE_KEY_COLUMNS = {
+    'staging_store_sales_header': {'transaction_date': 'transaction'},
+    'staging_customer_details': {'last_purchase_date': 'last_purchase'},
+    'staging_promotion_details': {'start_date': 'start', 'end_date': 'end'},
+    'staging_stores': {'opening_date': 'opening'},
+}
+
+# Julian day number of 1970-01-01, day key 0 (a Thursday)
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+UNIX_EPOCH_DATE = date(1970, 1, 1)
+
+def date_key_columns(date_column, prefix, storage='VIRTUAL'):
+    """Generated key columns of a date column (name -> declaration)
+
+    {prefix}_day: days since 1970-01-01; {prefix}_epoch: Unix seconds (time of day
+    included); {prefix}_week: Monday-based weeks since 1970; {prefix}_month: yyyymm.
+    Dates that do not parse give NULL keys.
+    """
+    day = f"CAST(julianday(substr({date_column}, 1, 10)) - {UNIX_EPOCH_JULIAN_DAY} AS INTEGER)"
+    expressions = {
+        f'{prefix}_day': day,
+        f'{prefix}_epoch': f"CAST(strftime('%s', {date_column}) AS INTEGER)",
+        f'{prefix}_week': f"({day} + 3) / 7",
+        f'{prefix}_month': f"CAST(strftime('%Y%m', {date_column}) AS INTEGER)",
+    }
+    return {name: f"INTEGER GENERATED ALWAYS AS ({expression}) {storage}" for name, expression in expressions.items()}
+
+def date_key_ddl(table, storage='STORED'):
+    """Column definitions of a table's date keys, for its CREATE TABLE statement"""
+    return ",\n                ".join(
+        f"{name} {declaration}"
+        for date_column, prefix in DATE_KEY_COLUMNS[table].items()
+        for name, declaration in date_key_columns(date_column, prefix, storage).items()
+    )
+
+def add_date_keys(conn, table):
+    """Add missing date keys to an existing table (ALTER TABLE can only add VIRTUAL ones)"""
+    added = []
+    for date_column, prefix in DATE_KEY_COLUMNS[table].items():
+        if date_column in get_table_columns(conn, table):
+            added += add_missing_columns(conn, table, date_key_columns(date_column, prefix))
+    return added
+
+def day_key(value):
+    """Day key of a 'YYYY-MM-DD...' string, date or timestamp, as stored in the {prefix}_day columns"""
+    if isinstance(value, str):
+        value = date.fromisoformat(value[:10])
+    elif isinstance(value, datetime):
+        value = value.date()
+    return (value - UNIX_EPOCH_DATE).days
+
+def weekday_of_day_key(day):
+    """Weekday (Monday = 0) of day keys (day 0 is a Thursday)"""
+    return (day + 3) % 7
 
 def get_db_path(db_name='retail_db.sqlite'):
     """Get database path relative to project root"""
@@ -9,217 +88,683 @@ def get_db_path(db_name='retail_db.sqlite'):
     project_root = os.path.dirname(current_dir)
     return os.path.join(project_root, db_name)
 
-def setup_database(db_path=None):
+def setup_database(db_path=None, conn=None):
     """Setup database with all required tables"""
     if db_path is None:
         db_path = get_db_path()
     
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Master data tables (staging schema)
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS staging_stores (
-            store_id TEXT PRIMARY KEY,
-            store_name TEXT,
-            store_city TEXT,
-            store_region TEXT,
-            opening_date TEXT
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS staging_products (
-            product_id TEXT PRIMARY KEY,
-            product_name TEXT,
-            product_category TEXT,
-            unit_price REAL,
-            current_stock_level INTEGER
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS staging_customer_details (
-            customer_id TEXT PRIMARY KEY,
-            first_name TEXT,
-            email TEXT,
-            loyalty_status TEXT,
-            total_loyalty_points INTEGER DEFAULT 0,
-            last_purchase_date TEXT,
-            segment_id TEXT
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS staging_promotion_details (
-            promotion_id TEXT PRIMARY KEY,
-            promotion_name TEXT,
-            start_date TEXT,
-            end_date TEXT,
-            discount_percentage REAL,
-            applicable_category TEXT
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS staging_loyalty_rules (
-            rule_id INTEGER PRIMARY KEY,
-            rule_name TEXT,
-            points_per_unit_spend REAL,
-            min_spend_threshold REAL,
-            bonus_points INTEGER
-        )
-    """)
-    
-    # Raw tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS raw_store_sales_header (
-            transaction_id TEXT PRIMARY KEY,
-            customer_id TEXT,
-            store_id TEXT,
-            transaction_date TEXT,
-            total_amount REAL,
-            load_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS raw_store_sales_line_items (
-            line_item_id INTEGER PRIMARY KEY,
-            transaction_id TEXT,
-            product_id TEXT,
-            promotion_id TEXT,
-            quantity INTEGER,
-            line_item_amount REAL,
-            load_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # Quarantine tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS quarantine_rejected_sales_header (
-            transaction_id TEXT PRIMARY KEY,
-            customer_id TEXT,
-            store_id TEXT,
-            transaction_date TEXT,
-            total_amount REAL,
-            rejection_reason TEXT,
-            rejection_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS quarantine_rejected_sales_line_items (
-            line_item_id INTEGER PRIMARY KEY,
-            transaction_id TEXT,
-            product_id TEXT,
-            promotion_id TEXT,
-            quantity INTEGER,
-            line_item_amount REAL,
-            rejection_reason TEXT,
-            rejection_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
-    
-    # Staging tables
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS staging_store_sales_header (
-            transaction_id TEXT PRIMARY KEY,
-            customer_id TEXT NOT NULL,
-            store_id TEXT NOT NULL,
-            transaction_date TEXT NOT NULL,
-            total_amount REAL NOT NULL,
-            processed INTEGER DEFAULT 0,
-            created_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        
+        # Master data tables (staging schema)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS staging_stores (
+                store_id TEXT PRIMARY KEY,
+                store_name TEXT,
+                store_city TEXT,
+                store_region TEXT,
+                opening_date TEXT
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS staging_products (
+                product_id TEXT PRIMARY KEY,
+                product_name TEXT,
+                product_category TEXT,
+                unit_price REAL,
+                current_stock_level INTEGER
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS staging_customer_details (
+                customer_id TEXT PRIMARY KEY,
+                first_name TEXT,
+                email TEXT,
+                loyalty_status TEXT,
+                total_loyalty_points INTEGER DEFAULT 0,
+                last_purchase_date TEXT,
+                segment_id TEXT
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS staging_promotion_details (
+                promotion_id TEXT PRIMARY KEY,
+                promotion_name TEXT,
+                start_date TEXT,
+                end_date TEXT,
+                discount_percentage REAL,
+                applicable_category TEXT
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS staging_loyalty_rules (
+                rule_id INTEGER PRIMARY KEY,
+                rule_name TEXT,
+                points_per_unit_spend REAL,
+                min_spend_threshold REAL,
+                bonus_points INTEGER,
+                applicable_days TEXT
+            )
+        """)
+        
+        # Raw tables
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS raw_store_sales_header (
+                transaction_id TEXT PRIMARY KEY,
+                customer_id TEXT,
+                store_id TEXT,
+                transaction_date TEXT,
+                total_amount REAL,
+                unparsed_values TEXT,
+                load_batch_id INTEGER,
+                load_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS raw_store_sales_line_items (
+                line_item_id INTEGER PRIMARY KEY,
+                transaction_id TEXT,
+                product_id TEXT,
+                promotion_id TEXT,
+                quantity INTEGER,
+                line_item_amount REAL,
+                unparsed_values TEXT,
+                load_batch_id INTEGER,
+                load_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Ingestion manifest: one row per loaded file, batch_id groups the files of one run
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingestion_manifest (
+                manifest_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id INTEGER NOT NULL,
+                target_table TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                file_size INTEGER,
+                file_mtime REAL,
+                checksum TEXT NOT NULL,
+                row_count INTEGER,
+                loaded_timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (target_table, checksum)
+            )
+        """)
+        
+        # Last load batch each incremental stage has consumed
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ingestion_watermarks (
+                stage TEXT PRIMARY KEY,
+                last_batch_id INTEGER NOT NULL,
+                updated_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Quarantine tables
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS quarantine_rejected_sales_header (
+                transaction_id TEXT PRIMARY KEY,
+                customer_id TEXT,
+                store_id TEXT,
+                transaction_date TEXT,
+                total_amount REAL,
+                unparsed_values TEXT,
+                rejection_reason TEXT,
+                rejection_mask INTEGER,
+                rejection_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS quarantine_rejected_sales_line_items (
+                line_item_id INTEGER PRIMARY KEY,
+                transaction_id TEXT,
+                product_id TEXT,
+                promotion_id TEXT,
+                quantity INTEGER,
+                line_item_amount REAL,
+                unparsed_values TEXT,
+                rejection_reason TEXT,
+                rejection_mask INTEGER,
+                rejection_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Staging tables
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS staging_store_sales_header (
+                transaction_id TEXT PRIMARY KEY,
+                customer_id TEXT NOT NULL,
+                store_id TEXT NOT NULL,
+                transaction_date TEXT NOT NULL,
+                total_amount REAL NOT NULL,
+                processed INTEGER DEFAULT 0,
+                aggregated INTEGER DEFAULT 0,
+                created_timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                {date_key_ddl('staging_store_sales_header')}
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS staging_store_sales_line_items (
+                line_item_id INTEGER PRIMARY KEY,
+                transaction_id TEXT NOT NULL,
+                product_id TEXT NOT NULL,
+                promotion_id TEXT,
+                quantity INTEGER NOT NULL,
+                line_item_amount REAL NOT NULL,
+                aggregated INTEGER DEFAULT 0,
+                created_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Use Case 2: Promotion effectiveness results
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS promotion_effectiveness (
+                promotion_id TEXT PRIMARY KEY,
+                promotion_name TEXT,
+                category TEXT,
+                baseline_sales REAL,
+                promoted_sales REAL,
+                sales_lift_percentage REAL,
+                rank INTEGER,
+                lift_ci_lower REAL,
+                lift_ci_upper REAL
+            )
+        """)
+        
+        # Use Case 2: Line-item sales per day, category and promotion ('' when not promoted);
+        # the key serves date-window lookups of one category. item_count and revenue_squares
+        # (sum of squared line-item amounts) give the variance of a sum for the lift intervals
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_category_sales (
+                category TEXT NOT NULL,
+                promotion_id TEXT NOT NULL DEFAULT '',
+                sale_day INTEGER NOT NULL,
+                total_quantity INTEGER,
+                total_revenue REAL,
+                item_count INTEGER,
+                revenue_squares REAL,
+                PRIMARY KEY (category, promotion_id, sale_day)
+            )
+        """)
+        
+        # Use Case 2: Running totals, maintained from newly routed line items only
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS promotion_sales_totals (
+                promotion_id TEXT NOT NULL,
+                category TEXT NOT NULL,
+                total_quantity INTEGER,
+                total_revenue REAL,
+                item_count INTEGER,
+                revenue_squares REAL,
+                PRIMARY KEY (promotion_id, category)
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS category_baseline_totals (
+                category TEXT PRIMARY KEY,
+                total_quantity INTEGER,
+                total_revenue REAL,
+                item_count INTEGER,
+                revenue_squares REAL
+            )
+        """)
+        
+        # Use Case 2: Streaming leaderboard counters ('promoted' by promotion, 'baseline'
+        # by category, 'daily' by sale date), checkpointed with the feed offset
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS promotion_stream_counters (
+                feed TEXT NOT NULL,
+                counter TEXT NOT NULL,
+                counter_key TEXT NOT NULL,
+                category TEXT NOT NULL,
+                revenue REAL,
+                PRIMARY KEY (feed, counter, counter_key, category)
+            )
+        """)
+        
+        # Byte offset of each feed's last checkpoint (a read position, not a load batch)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS promotion_stream_state (
+                feed TEXT PRIMARY KEY,
+                byte_offset INTEGER NOT NULL,
+                updated_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS promotion_stream_leaderboard (
+                feed TEXT NOT NULL,
+                rank INTEGER NOT NULL,
+                promotion_id TEXT,
+                promotion_name TEXT,
+                category TEXT,
+                baseline_sales REAL,
+                promoted_sales REAL,
+                sales_lift_percentage REAL,
+                published_timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (feed, rank, promotion_id, category)
+            )
+        """)
+        
+        # Use Case 3: Loyalty point transactions
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS loyalty_point_transactions (
+                transaction_id TEXT PRIMARY KEY,
+                customer_id TEXT,
+                transaction_amount REAL,
+                points_earned INTEGER,
+                rule_applied TEXT,
+                transaction_date TEXT,
+                run_id INTEGER,
+                accrued_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Loyalty accrual runs: checkpointed after every committed batch
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS loyalty_accrual_runs (
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                status TEXT NOT NULL,
+                transactions_accrued INTEGER DEFAULT 0,
+                points_accrued INTEGER DEFAULT 0,
+                last_transaction_id TEXT,
+                started_timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                checkpoint_timestamp TEXT
+            )
+        """)
+        
+        # Customer balances as of a ledger date (everything accrued up to snapshot_date)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS loyalty_balance_snapshots (
+                customer_id TEXT NOT NULL,
+                snapshot_date TEXT NOT NULL,
+                balance INTEGER,
+                created_timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (customer_id, snapshot_date)
+            )
+        """)
+        
+        # Ledger compactions: rows up to compacted_through are folded per customer
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS loyalty_ledger_compactions (
+                compacted_through TEXT PRIMARY KEY,
+                rows_folded INTEGER,
+                compacted_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Transactions whose ledger rows a compaction folded: they have been paid and announced
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS compacted_transactions (
+                transaction_id TEXT PRIMARY KEY,
+                compacted_through TEXT NOT NULL
+            )
+        """)
+        
+        # Use Case 4: Customer segments
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS customer_segments (
+                customer_id TEXT PRIMARY KEY,
+                segment_name TEXT,
+                recency_days INTEGER,
+                frequency INTEGER,
+                monetary_value REAL,
+                loyalty_points INTEGER,
+                r_score INTEGER,
+                f_score INTEGER,
+                m_score INTEGER,
+                last_purchase_day INTEGER,
+                segment_date TEXT DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Use Case 4: Population state the stored scores were assigned against: four quintile
+        # boundaries per score (r_score as purchase day keys), the High-Spenders cut-off
+        # ('high_spender') and the day recency was measured from ('reference_day')
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS customer_score_boundaries (
+                score TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                boundary REAL,
+                PRIMARY KEY (score, position)
+            )
+        """)
+        
+        # Use Case 4: Customers whose purchase totals changed since their segment was assigned
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS customer_segment_changes (
+                customer_id TEXT PRIMARY KEY
+            )
+        """)
+        
+        # Use Case 4: Running purchase totals per customer, maintained from new transactions only
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS customer_purchase_totals (
+                customer_id TEXT PRIMARY KEY,
+                last_purchase_date TEXT,
+                last_purchase_day INTEGER,
+                transaction_count INTEGER,
+                total_spend REAL
+            )
+        """)
+        
+        # Use Case 5: Notification outbox, one row per accrued ledger transaction;
+        # 'pending' rows are delivered by the dispatcher, retried at next_attempt_at
+        # (Unix seconds) until 'sent' or 'failed'
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS loyalty_notifications (
+                notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                customer_id TEXT,
+                email TEXT,
+                subject TEXT,
+                body TEXT,
+                points_earned INTEGER,
+                total_points INTEGER,
+                status TEXT DEFAULT 'pending',
+                created_timestamp TEXT DEFAULT CURRENT_TIMESTAMP,
+                transaction_id TEXT,
+                domain TEXT,
+                attempts INTEGER DEFAULT 0,
+                next_attempt_at REAL,
+                last_error TEXT,
+                sent_timestamp TEXT
+            )
+        """)
+        
+        # Use Case 6: Inventory analysis
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS inventory_analysis (
+                product_id TEXT,
+                store_id TEXT,
+                total_days INTEGER,
+                out_of_stock_days INTEGER,
+                out_of_stock_percentage REAL,
+                estimated_lost_sales REAL,
+                analysis_date TEXT DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (product_id, store_id)
+            )
+        """)
+        
+        # Columns added after the first release; CREATE TABLE IF NOT EXISTS leaves old tables as they were
+        add_missing_columns(conn, 'quarantine_rejected_sales_header', {'rejection_mask': 'INTEGER'})
+        add_missing_columns(conn, 'quarantine_rejected_sales_line_items', {'rejection_mask': 'INTEGER'})
+        add_missing_columns(conn, 'raw_store_sales_header', {'load_batch_id': 'INTEGER'})
+        add_missing_columns(conn, 'raw_store_sales_line_items', {'load_batch_id': 'INTEGER'})
+        for table in ['raw_store_sales_header', 'raw_store_sales_line_items',
+                      'quarantine_rejected_sales_header', 'quarantine_rejected_sales_line_items']:
+            add_missing_columns(conn, table, {'unparsed_values': 'TEXT'})
+        add_missing_columns(conn, 'staging_loyalty_rules', {'applicable_days': 'TEXT'})
+        add_missing_columns(conn, 'loyalty_point_transactions', {'run_id': 'INTEGER', 'accrued_timestamp': 'TEXT'})
+        add_missing_columns(conn, 'staging_store_sales_line_items', {'aggregated': 'INTEGER DEFAULT 0'})
+        add_missing_columns(conn, 'staging_store_sales_header', {'aggregated': 'INTEGER DEFAULT 0'})
+        add_missing_columns(conn, 'promotion_effectiveness', {'lift_ci_lower': 'REAL', 'lift_ci_upper': 'REAL'})
+        add_missing_columns(conn, 'customer_segments', {'r_score': 'INTEGER', 'f_score': 'INTEGER', 'm_score': 'INTEGER'})
+        if add_missing_columns(conn, 'customer_segments', {'last_purchase_day': 'INTEGER'}):
+            # Segments stored without purchase days are reassigned from scratch
+            cursor.execute("DELETE FROM customer_segments")
+            cursor.execute("DELETE FROM customer_score_boundaries")
+        add_missing_columns(conn, 'loyalty_notifications', {
+            'transaction_id': 'TEXT', 'domain': 'TEXT', 'attempts': 'INTEGER DEFAULT 0',
+            'next_attempt_at': 'REAL', 'last_error': 'TEXT', 'sent_timestamp': 'TEXT',
+        })
+        for table in DATE_KEY_COLUMNS:
+            add_date_keys(conn, table)
+        
+        conn.commit()
+    return db_path
+
+# Secondary indexes built once a bulk load is done: (index_name, table, columns)
+INDEX_DEFINITIONS = [
+    ('idx_raw_header_customer_id', 'raw_store_sales_header', 'customer_id'),
+    ('idx_raw_header_store_id', 'raw_store_sales_header', 'store_id'),
+    ('idx_raw_line_items_transaction_id', 'raw_store_sales_line_items', 'transaction_id'),
+    ('idx_raw_line_items_product_id', 'raw_store_sales_line_items', 'product_id'),
+    ('idx_raw_header_load_batch_id', 'raw_store_sales_header', 'load_batch_id'),
+    ('idx_raw_line_items_load_batch_id', 'raw_store_sales_line_items', 'load_batch_id'),
+    ('idx_quarantine_line_items_transaction_id', 'quarantine_rejected_sales_line_items', 'transaction_id'),
+    ('idx_staging_header_customer_id', 'staging_store_sales_header', 'customer_id'),
+    ('idx_staging_header_store_id', 'staging_store_sales_header', 'store_id'),
+    ('idx_staging_line_items_transaction_id', 'staging_store_sales_line_items', 'transaction_id'),
+    ('idx_staging_line_items_product_id', 'staging_store_sales_line_items', 'product_id'),
+    # Date-range chunks of the loyalty backfill
+    ('idx_staging_header_transaction_epoch', 'staging_store_sales_header', 'transaction_epoch'),
+    # Distinct sales days and newest sales day
+    ('idx_staging_header_transaction_day', 'staging_store_sales_header', 'transaction_day'),
+    # Covers ledger tails of one customer, so point-in-time balance lookups never touch the table
+    ('idx_loyalty_ledger_customer_date', 'loyalty_point_transactions', 'customer_id, transaction_date, points_earned'),
+    # Quintile boundaries and the High-Spenders cut-off are read by position from these
+    ('idx_segments_frequency', 'customer_segments', 'frequency'),
+    ('idx_segments_monetary_value', 'customer_segments', 'monetary_value'),
+    ('idx_segments_last_purchase_day', 'customer_segments', 'last_purchase_day'),
+    # Ledger transactions already in the notification outbox
+    ('idx_notifications_transaction_id', 'loyalty_notifications', 'transaction_id'),
+]
+
+# Partial indexes covering only the rows a predicate selects: (index_name, table, columns, predicate)
+PARTIAL_INDEX_DEFINITIONS = [
+    # Loyalty accrual only ever looks for unprocessed headers
+    ('idx_staging_header_unprocessed', 'staging_store_sales_header', 'transaction_id', 'processed = 0'),
+    # Promotion aggregates only ever fold line items not yet aggregated
+    ('idx_staging_line_items_unaggregated', 'staging_store_sales_line_items', 'line_item_id', 'aggregated = 0'),
+    # Customer purchase totals only ever fold transactions not yet aggregated
+    ('idx_staging_header_unaggregated', 'staging_store_sales_header', 'transaction_id', 'aggregated = 0'),
+    # The notification dispatcher only ever reads undelivered outbox rows
+    ('idx_notifications_pending', 'loyalty_notifications', 'notification_id', "status = 'pending'"),
+]
+
+def index_definitions(tables=None):
+    """(index_name, table, columns, predicate or None) of the managed indexes on tables"""
+    definitions = [(*definition, None) for definition in INDEX_DEFINITIONS] + PARTIAL_INDEX_DEFINITIONS
+    return [definition for definition in definitions if tables is None or definition[1] in tables]
+
+def _create_index_sql(index_name, table, columns, predicate=None):
+    """CREATE INDEX statement of a managed index"""
+    where = f" WHERE {predicate}" if predicate else ""
+    return f"CREATE INDEX IF NOT EXISTS {index_name} ON {table} ({columns}){where}"
+
+# Staging tables rebuilt as a whole by routing and swapped in from shadow tables
+STAGING_SALES_TABLES = ['staging_store_sales_header', 'staging_store_sales_line_items']
+
+# Previous staging generations kept after a swap (for rollback and comparison)
+DEFAULT_STAGING_RETENTION = 1
+
+def get_table_columns(conn, table):
+    """Get column names of a table, generated ones included (empty if the table does not exist)"""
+    return [row[1] for row in conn.execute(f"PRAGMA table_xinfo({table})")]
+
+def add_missing_columns(conn, table, columns):
+    """Add columns (name -> declaration) that an existing table does not have yet"""
+    existing = get_table_columns(conn, table)
+    if not existing:
+        return []
+    added = [name for name in columns if name not in existing]
+    for name in added:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {columns[name]}")
+    return added
+
+def restore_declared_schema(conn, tables):
+    """Recreate tables that a replace-mode load stripped of their declared keys"""
+    stripped = []
+    for table in tables:
+        table_info = conn.execute(f"PRAGMA table_info({table})").fetchall()
+        if table_info and not any(row[5] for row in table_info):
+            conn.execute(f"DROP TABLE {table}")
+            stripped.append(table)
     
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS staging_store_sales_line_items (
-            line_item_id INTEGER PRIMARY KEY,
-            transaction_id TEXT NOT NULL,
-            product_id TEXT NOT NULL,
-            promotion_id TEXT,
-            quantity INTEGER NOT NULL,
-            line_item_amount REAL NOT NULL,
-            created_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    if stripped:
+        setup_database(conn=conn)
+        print(f"[OK] Restored declared schema: {', '.join(stripped)}")
+    return stripped
+
+def drop_indexes(conn, tables=None):
+    """Drop secondary indexes so a bulk load does not maintain them row by row"""
+    for index_name, _, _, _ in index_definitions(tables):
+        conn.execute(f"DROP INDEX IF EXISTS {index_name}")
+
+def create_indexes(conn, tables=None):
+    """Create secondary indexes after a bulk load, returns indexes created"""
+    created = 0
+    for index_name, table, columns, predicate in index_definitions(tables):
+        existing = get_table_columns(conn, table)
+        if not all(col.strip() in existing for col in columns.split(',')):
+            continue
+        conn.execute(_create_index_sql(index_name, table, columns, predicate))
+        created += 1
+    # Refresh planner statistics only where SQLite thinks they are stale
+    conn.execute("PRAGMA optimize")
+    conn.commit()
+    return created
+
+def create_shadow_table(conn, table):
+    """Create an empty shadow copy of a table with its declared schema, returns its name"""
+    shadow = f"{table}_shadow"
+    conn.execute(f"DROP TABLE IF EXISTS {shadow}")
+    ddl = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()[0]
+    conn.execute(ddl.replace(table, shadow, 1))
+    return shadow
+
+def get_generations(conn, table):
+    """Retained generations of a swapped table as (generation, name), newest first"""
+    prefix = f"{table}_gen_"
+    names = conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND substr(name, 1, ?) = ?",
+                         (len(prefix), prefix))
+    generations = [(int(name[len(prefix):]), name) for name, in names if name[len(prefix):].isdigit()]
+    return sorted(generations, reverse=True)
+
+def prune_generations(conn, tables, retention=DEFAULT_STAGING_RETENTION):
+    """Drop generations beyond the newest retention ones, returns tables dropped"""
+    dropped = []
+    for table in tables:
+        for _, name in get_generations(conn, table)[retention:]:
+            conn.execute(f"DROP TABLE {name}")
+            dropped.append(name)
+    conn.commit()
+    return dropped
+
+def swap_shadow_tables(conn, tables, retention=DEFAULT_STAGING_RETENTION):
+    """Atomically replace live tables by their shadows, returns the retired generation number
+
+    The live tables are renamed to <table>_gen_<n> and the shadows take their
+    names in one transaction, so readers see either the old or the new
+    generation. The database is switched to WAL first if it is not in WAL
+    already, so readers are not blocked by the swap either.
+    """
+    conn.commit()
+    # A rollback journal would lock readers out while the swap commits; WAL sticks to the file
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != 'wal':
+        try:
+            journal_mode = conn.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+        except sqlite3.OperationalError:
+            journal_mode = None
+        if journal_mode != 'wal':
+            print("[WARN] Could not switch to WAL, readers may block while staging is swapped")
+    generation = 1 + max((gen for table in tables for gen, _ in get_generations(conn, table)), default=0)
     
-    # Use Case 2: Promotion effectiveness results
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS promotion_effectiveness (
-            promotion_id TEXT PRIMARY KEY,
-            promotion_name TEXT,
-            category TEXT,
-            baseline_sales REAL,
-            promoted_sales REAL,
-            sales_lift_percentage REAL,
-            rank INTEGER
-        )
-    """)
+    # Renames must not rewrite references to the live names in other schema objects
+    conn.execute("PRAGMA legacy_alter_table = ON")
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Index names are global: move them from the retired tables to the new live ones
+            drop_indexes(conn, tables)
+            for table in tables:
+                conn.execute(f"ALTER TABLE {table} RENAME TO {table}_gen_{generation}")
+                conn.execute(f"ALTER TABLE {table}_shadow RENAME TO {table}")
+            for definition in index_definitions(tables):
+                conn.execute(_create_index_sql(*definition))
+            # Consumers keeping running aggregates of a swapped table must rebuild them
+            for table in tables:
+                mark_reloaded(conn, table)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    finally:
+        conn.execute("PRAGMA legacy_alter_table = OFF")
     
-    # Use Case 3: Loyalty point transactions
+    prune_generations(conn, tables, retention)
+    return generation
+
+def report_indexes(conn):
+    """Report existing indexes and their on-disk size"""
+    cursor = conn.cursor()
     cursor.execute("""
-        CREATE TABLE IF NOT EXISTS loyalty_point_transactions (
-            transaction_id TEXT PRIMARY KEY,
-            customer_id TEXT,
-            transaction_amount REAL,
-            points_earned INTEGER,
-            rule_applied TEXT,
-            transaction_date TEXT
-        )
+        SELECT name, tbl_name
+        FROM sqlite_master
+        WHERE type = 'index'
+        ORDER BY tbl_name, name
     """)
+    indexes = cursor.fetchall()
     
-    # Use Case 4: Customer segments
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS customer_segments (
-            customer_id TEXT PRIMARY KEY,
-            segment_name TEXT,
-            recency_days INTEGER,
-            frequency INTEGER,
-            monetary_value REAL,
-            loyalty_points INTEGER,
-            segment_date TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    # dbstat is optional in SQLite builds; report sizes only when it is available
+    sizes = {}
+    try:
+        cursor.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name")
+        sizes = dict(cursor.fetchall())
+    except sqlite3.OperationalError:
+        pass
     
-    # Use Case 5: Notifications
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS loyalty_notifications (
-            notification_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_id TEXT,
-            email TEXT,
-            subject TEXT,
-            body TEXT,
-            points_earned INTEGER,
-            total_points INTEGER,
-            status TEXT DEFAULT 'pending',
-            created_timestamp TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    """)
+    report = [(name, table, sizes.get(name)) for name, table in indexes]
     
-    # Use Case 6: Inventory analysis
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS inventory_analysis (
-            product_id TEXT,
-            store_id TEXT,
-            total_days INTEGER,
-            out_of_stock_days INTEGER,
-            out_of_stock_percentage REAL,
-            estimated_lost_sales REAL,
-            analysis_date TEXT DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (product_id, store_id)
-        )
-    """)
+    print("\nIndexes:")
+    print("-" * 80)
+    for name, table, size in report:
+        size_text = f"{size / 1024:.1f} KB" if size is not None else "n/a"
+        print(f"  {table:<40} {name:<45} {size_text}")
     
-    conn.commit()
-    conn.close()
-    return db_path
+    return report
+
+def apply_profile(conn, profile):
+    """Apply a named PRAGMA tuning profile to an open connection"""
+    if profile not in PRAGMA_PROFILES:
+        raise ValueError(f"Unknown PRAGMA profile: {profile} (expected one of {', '.join(PRAGMA_PROFILES)})")
+    for pragma, value in PRAGMA_PROFILES[profile].items():
+        conn.execute(f"PRAGMA {pragma} = {value}")
+    return conn
 
-def get_connection(db_path=None):
-    """Get database connection"""
+def get_watermark(conn, stage):
+    """Last load batch an incremental stage has consumed (0 before the first run)"""
+    row = conn.execute("SELECT last_batch_id FROM ingestion_watermarks WHERE stage = ?", (stage,)).fetchone()
+    return row[0] if row else 0
+
+def set_watermark(conn, stage, batch_id):
+    """Advance an incremental stage's watermark"""
+    conn.execute("""
+        INSERT INTO ingestion_watermarks (stage, last_batch_id, updated_timestamp)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(stage) DO UPDATE SET
+            last_batch_id = excluded.last_batch_id,
+            updated_timestamp = excluded.updated_timestamp
+    """, (stage, batch_id))
+
+def mark_reloaded(conn, table):
+    """Count a full reload of a table; consumers compare the count to their own watermark"""
+    stage = f"reload:{table}"
+    set_watermark(conn, stage, get_watermark(conn, stage) + 1)
+
+def get_connection(db_path=None, profile='default'):
+    """Get database connection tuned with a PRAGMA profile"""
     if db_path is None:
         db_path = get_db_path()
-    return sqlite3.connect(db_path)
+    return apply_profile(sqlite3.connect(db_path), profile)
+
+@contextmanager
+def connection_scope(db_path, conn=None):
+    """Yield the shared pipeline connection, or a private one closed on exit"""
+    if conn is not None:
+        yield conn
+        return
+    
+    conn = get_connection(db_path)
+    try:
+        yield conn
+    finally:
+        conn.close()
 
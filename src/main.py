@@ -1,16 +1,27 @@
 """Main pipeline orchestrator for all use cases"""
 import sys
 import os
-from common.database import setup_database, get_db_path
+import argparse
+from common.database import (
+    setup_database, get_db_path, get_connection, report_indexes, PRAGMA_PROFILES, DEFAULT_STAGING_RETENTION,
+)
+from common.data_loader import report_parse_memory, pending_files
 from usecase1.data_ingestion import execute as execute_usecase1
 from usecase2.promotion_analyzer import execute as execute_usecase2
+from usecase2.promotion_stream import run_leaderboard_service, DEFAULT_TOP_K, DEFAULT_PUBLISH_INTERVAL
 from usecase3.loyalty_engine import execute as execute_usecase3
-from usecase4.customer_segmentation import execute as execute_usecase4
+from usecase3.rule_simulation import load_rule_set, simulate_rule_sets, backfill_loyalty_points
+from usecase4.customer_segmentation import execute as execute_usecase4, update_customer_totals
+from usecase4.quantile_sketch import check_sketch_error, DEFAULT_SKETCH_ERROR
 from usecase5.notification_system import execute as execute_usecase5
+from usecase5.notification_dispatcher import smtp_sink, DEFAULT_WORKERS as DEFAULT_NOTIFICATION_WORKERS
 from usecase6.inventory_analysis import execute as execute_usecase6
 
-def run_all_usecases():
-    """Run all use cases in sequence"""
+def run_all_usecases(chunksize=None, keep_schema=False, prevalidate=False, profile='default', append=False,
+                     parallel=False, workers=None, retention=DEFAULT_STAGING_RETENTION, compact_before=None,
+                     loyalty_workers=None, check_determinism=False, sketch_error=None, sketch_workers=None,
+                     notification_workers=DEFAULT_NOTIFICATION_WORKERS, smtp=None, verbose=False):
+    """Run all use cases in sequence over one shared, profile-tuned connection"""
     print("="*80)
     print("RETAIL DATA PROCESSING PIPELINE - ALL USE CASES")
     print("="*80)
@@ -19,16 +30,30 @@ def run_all_usecases():
     db_path = setup_database()
     print(f"\n[OK] Database initialized: {db_path}")
     
+    # One connection for the whole run, tuned by the selected PRAGMA profile
+    conn = get_connection(db_path, profile=profile)
+    print(f"[OK] Connection profile: {profile}")
+    
     # Execute all use cases
     results = {}
     
     try:
-        results['usecase1'] = execute_usecase1(db_path)
-        results['usecase2'] = execute_usecase2(db_path)
-        results['usecase3'] = execute_usecase3(db_path)
-        results['usecase4'] = execute_usecase4(db_path)
-        results['usecase5'] = execute_usecase5(db_path)
-        results['usecase6'] = execute_usecase6(db_path)
+        if append and not pending_files(conn):
+            print("\n[OK] No new data since the last run")
+            return results
+        
+        results['usecase1'] = execute_usecase1(db_path, chunksize=chunksize, keep_schema=keep_schema,
+                                               prevalidate=prevalidate, append=append,
+                                               parallel=parallel, workers=workers, retention=retention,
+                                               verbose=verbose, conn=conn)
+        results['usecase2'] = execute_usecase2(db_path, conn=conn)
+        results['usecase3'] = execute_usecase3(db_path, compact_before=compact_before, workers=loyalty_workers,
+                                               check_determinism=check_determinism, conn=conn)
+        results['usecase4'] = execute_usecase4(db_path, sketch_error=sketch_error, workers=sketch_workers,
+                                               conn=conn)
+        sink = smtp_sink(*smtp) if smtp else None
+        results['usecase5'] = execute_usecase5(db_path, sink=sink, workers=notification_workers, conn=conn)
+        results['usecase6'] = execute_usecase6(db_path, conn=conn)
         
         print("\n" + "="*80)
         print("ALL USE CASES COMPLETED SUCCESSFULLY")
@@ -40,7 +65,99 @@ def run_all_usecases():
         import traceback
         traceback.print_exc()
         return None
+    finally:
+        conn.close()
+
+def smtp_address(value):
+    """(host, port) of a HOST:PORT argument"""
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError(f"expected HOST:PORT, got {value!r}")
+    return host, int(port)
+
+def parse_args(argv=None):
+    """Parse command line options"""
+    parser = argparse.ArgumentParser(description="Run the retail data processing pipeline")
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help="Stream raw sales CSVs in chunks of this many rows")
+    parser.add_argument('--keep-schema', action='store_true',
+                        help="Load into the declared tables instead of replacing them")
+    parser.add_argument('--prevalidate', action='store_true',
+                        help="Validate sales CSV chunks in memory and load only valid rows")
+    parser.add_argument('--parallel', action='store_true',
+                        help="Pre-validate every store_sales_*_<partition>.csv file in a process pool")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Worker processes for --parallel ingestion (default: all cores)")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Print rows/sec for every chunk of --chunksize/--prevalidate loads")
+    parser.add_argument('--staging-retention', type=int, default=DEFAULT_STAGING_RETENTION,
+                        help="Previous staging generations to keep after each swap")
+    parser.add_argument('--compact-ledger-before', metavar='DATE', default=None,
+                        help="Fold loyalty ledger rows up to the newest balance snapshot before DATE")
+    parser.add_argument('--loyalty-workers', type=int, default=None,
+                        help="Price loyalty accrual batches in this many processes, sharded by customer")
+    parser.add_argument('--check-determinism', action='store_true',
+                        help="Before parallel accrual, verify it matches a serial run on a copy")
+    parser.add_argument('--append', action='store_true',
+                        help="Ingest only data files not loaded by a previous run")
+    parser.add_argument('--profile', choices=sorted(PRAGMA_PROFILES), default='default',
+                        help="SQLite PRAGMA tuning profile for the pipeline connection")
+    parser.add_argument('--simulate-rules', nargs='+', metavar='RULES_CSV', default=None,
+                        help="Report loyalty points the history would earn under candidate rule files, then exit")
+    parser.add_argument('--backfill-loyalty', nargs='?', const='', metavar='RULES_CSV', default=None,
+                        help="Recompute accrued loyalty points under a rule file (default: current rules), then exit")
+    parser.add_argument('--backfill-workers', type=int, default=None,
+                        help="Processes pricing --backfill-loyalty date chunks (default: all cores)")
+    parser.add_argument('--stream-leaderboard', metavar='FEED', default=None,
+                        help="Tail a line-item event file and publish the top promotions until interrupted")
+    parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K,
+                        help="Promotions on the streaming leaderboard")
+    parser.add_argument('--publish-interval', type=float, default=DEFAULT_PUBLISH_INTERVAL,
+                        help="Seconds between leaderboard publishes and checkpoints")
+    parser.add_argument('--spend-sketch-error', type=float, default=None, metavar='ERROR',
+                        help="Take the High-Spenders cut-off from a quantile sketch with this rank error")
+    parser.add_argument('--sketch-workers', type=int, default=None,
+                        help="Processes feeding the spend sketch, each over its own rowid range")
+    parser.add_argument('--check-sketch', nargs='?', type=float, const=DEFAULT_SKETCH_ERROR, metavar='ERROR',
+                        default=None, help="Report spend sketch thresholds against the exact ones, then exit")
+    parser.add_argument('--notification-workers', type=int, default=DEFAULT_NOTIFICATION_WORKERS,
+                        help="Concurrent notification senders")
+    parser.add_argument('--smtp', metavar='HOST:PORT', type=smtp_address, default=None,
+                        help="Send notifications through this SMTP server instead of the local mbox file")
+    parser.add_argument('--report-indexes', action='store_true',
+                        help="Report existing indexes and their size, then exit")
+    parser.add_argument('--report-memory', action='store_true',
+                        help="Report untyped vs profiled parse memory per data file, then exit")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    run_all_usecases()
+    args = parse_args()
+    if args.report_indexes:
+        conn = get_connection()
+        report_indexes(conn)
+        conn.close()
+    elif args.report_memory:
+        report_parse_memory()
+    elif args.check_sketch is not None:
+        # Fold any new transactions so the sketch and the exact answer see current totals
+        conn = get_connection(setup_database())
+        update_customer_totals(conn)
+        check_sketch_error(get_db_path(), error=args.check_sketch, workers=args.sketch_workers, conn=conn)
+        conn.close()
+    elif args.stream_leaderboard:
+        run_leaderboard_service(setup_database(), args.stream_leaderboard, top_k=args.top_k,
+                                interval=args.publish_interval)
+    elif args.simulate_rules:
+        simulate_rule_sets(get_db_path(), {path: load_rule_set(path) for path in args.simulate_rules})
+    elif args.backfill_loyalty is not None:
+        rules = load_rule_set(args.backfill_loyalty) if args.backfill_loyalty else None
+        backfill_loyalty_points(get_db_path(), rules=rules, workers=args.backfill_workers)
+    else:
+        run_all_usecases(chunksize=args.chunksize, keep_schema=args.keep_schema,
+                         prevalidate=args.prevalidate, profile=args.profile, append=args.append,
+                         parallel=args.parallel, workers=args.workers, retention=args.staging_retention,
+                         compact_before=args.compact_ledger_before, loyalty_workers=args.loyalty_workers,
+                         check_determinism=args.check_determinism, sketch_error=args.spend_sketch_error,
+                         sketch_workers=args.sketch_workers, notification_workers=args.notification_workers,
+                         smtp=args.smtp, verbose=args.verbose)
 
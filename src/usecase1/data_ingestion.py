@@ -3,250 +3,262 @@ import sqlite3
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from common.database import get_connection
-from common.data_loader import load_master_data, load_raw_sales_data
+from common.database import (
+    get_connection, connection_scope, create_indexes, get_watermark, set_watermark,
+    create_shadow_table, swap_shadow_tables, STAGING_SALES_TABLES, DEFAULT_STAGING_RETENTION,
+)
+from common.data_loader import (
+    load_master_data, load_raw_sales_data, append_raw_sales_data, next_batch_id, reset_manifest,
+    DEFAULT_CHUNK_SIZE,
+)
+from usecase1.validation_rules import HEADER_VALIDATION, LINE_ITEM_VALIDATION, apply_rules
+from usecase1.prevalidation import prevalidate_raw_sales_data
+from usecase1.parallel_ingestion import parallel_prevalidate_raw_sales_data
 
-def normalize_data(db_path):
-    """Normalize data (1NF, 2NF, 3NF)"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # 1NF: Split multi-value product_ids in line items
-    # Check if there are any comma-separated product_ids
-    cursor.execute("""
-        SELECT line_item_id, product_id, quantity, line_item_amount, transaction_id
-        FROM raw_store_sales_line_items
-        WHERE product_id LIKE '%,%'
-    """)
-    
-    multi_value_items = cursor.fetchall()
-    if multi_value_items:
-        for item in multi_value_items:
-            line_item_id, product_ids_str, qty, amount, txn_id = item
-            product_ids = [p.strip() for p in product_ids_str.split(',')]
-            
-            # Delete original record
-            cursor.execute("DELETE FROM raw_store_sales_line_items WHERE line_item_id = ?", (line_item_id,))
-            
-            # Insert split records
-            per_product_amount = amount / len(product_ids)
-            per_product_qty = qty // len(product_ids)
-            remainder_qty = qty % len(product_ids)
-            
-            for idx, pid in enumerate(product_ids):
-                new_line_item_id = line_item_id * 1000 + idx  # Create unique ID
-                new_qty = per_product_qty + (1 if idx < remainder_qty else 0)
-                new_amount = per_product_amount
-                
-                cursor.execute("""
-                    INSERT INTO raw_store_sales_line_items 
-                    (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount)
-                    VALUES (?, ?, ?, NULL, ?, ?)
-                """, (new_line_item_id, txn_id, pid, new_qty, new_amount))
-    
-    conn.commit()
-    conn.close()
+def _batch_filter(since_batch, alias=''):
+    """SQL condition limiting raw rows to load batches after since_batch"""
+    if since_batch is None:
+        return ""
+    return f"AND {alias}load_batch_id > {int(since_batch)}"
+
+def normalize_data(db_path, since_batch=None, conn=None):
+    """Normalize data (1NF, 2NF, 3NF), only batches after since_batch when given"""
+    batch_filter = _batch_filter(since_batch)
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        
+        # 1NF: Split multi-value product_ids in line items in one set-based pass.
+        # The recursive CTE peels one product off the list per step; split rows get
+        # negative line_item_ids below the current minimum, a range delivered ids never
+        # use, so a later append can not collide with them.
+        cursor.execute("DROP TABLE IF EXISTS temp.split_line_items")
+        cursor.execute("""
+            CREATE TEMP TABLE split_line_items AS
+            WITH RECURSIVE split(line_item_id, transaction_id, quantity, line_item_amount, unparsed_values,
+                                 load_batch_id, product_count, idx, product_id, rest) AS (
+                SELECT line_item_id, transaction_id, quantity, line_item_amount, unparsed_values, load_batch_id,
+                       LENGTH(product_id) - LENGTH(REPLACE(product_id, ',', '')) + 1,
+                       0,
+                       SUBSTR(product_id, 1, INSTR(product_id, ',') - 1),
+                       SUBSTR(product_id, INSTR(product_id, ',') + 1)
+                FROM raw_store_sales_line_items
+                WHERE product_id LIKE '%,%' {batch_filter}
+                UNION ALL
+                SELECT line_item_id, transaction_id, quantity, line_item_amount, unparsed_values, load_batch_id,
+                       product_count, idx + 1,
+                       CASE WHEN INSTR(rest, ',') > 0 THEN SUBSTR(rest, 1, INSTR(rest, ',') - 1) ELSE rest END,
+                       CASE WHEN INSTR(rest, ',') > 0 THEN SUBSTR(rest, INSTR(rest, ',') + 1) END
+                FROM split
+                WHERE rest IS NOT NULL
+            )
+            SELECT
+                (SELECT MIN(0, COALESCE(MIN(line_item_id), 0)) FROM raw_store_sales_line_items)
+                    - ROW_NUMBER() OVER (ORDER BY line_item_id, idx) AS line_item_id,
+                transaction_id,
+                TRIM(product_id) AS product_id,
+                -- Spread the quantity evenly, first products take the remainder
+                CAST(quantity AS INTEGER) / product_count
+                    + (idx < CAST(quantity AS INTEGER) % product_count) AS quantity,
+                line_item_amount * 1.0 / product_count AS line_item_amount,
+                unparsed_values,
+                load_batch_id
+            FROM split
+        """.format(batch_filter=batch_filter))
+        
+        cursor.execute(f"DELETE FROM raw_store_sales_line_items WHERE product_id LIKE '%,%' {batch_filter}")
+        split_rows = cursor.rowcount
+        
+        cursor.execute("""
+            INSERT INTO raw_store_sales_line_items 
+            (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount, unparsed_values,
+             load_batch_id)
+            SELECT line_item_id, transaction_id, product_id, NULL, quantity, line_item_amount, unparsed_values,
+                   load_batch_id
+            FROM temp.split_line_items
+        """)
+        
+        if split_rows:
+            print(f"[OK] 1NF: Split {split_rows} multi-value rows into {cursor.rowcount} line items")
+        cursor.execute("DROP TABLE temp.split_line_items")
+        
+        conn.commit()
     print("[OK] Data normalization complete")
 
-def validate_headers(db_path):
-    """Validate header records"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Rule 1: Missing customer_id
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_header 
-        (transaction_id, customer_id, store_id, transaction_date, total_amount, rejection_reason)
-        SELECT transaction_id, customer_id, store_id, transaction_date, total_amount, 
-               'REJECTED: Missing or NULL customer_id'
-        FROM raw_store_sales_header
-        WHERE (customer_id IS NULL OR customer_id = '' OR customer_id = 'INVALID')
-        AND transaction_id NOT IN (SELECT transaction_id FROM quarantine_rejected_sales_header)
-    """)
-    
-    # Rule 2: Invalid store_id
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_header 
-        (transaction_id, customer_id, store_id, transaction_date, total_amount, rejection_reason)
-        SELECT r.transaction_id, r.customer_id, r.store_id, r.transaction_date, r.total_amount, 
-               'REJECTED: Invalid store_id'
-        FROM raw_store_sales_header r
-        LEFT JOIN staging_stores s ON r.store_id = s.store_id
-        WHERE s.store_id IS NULL
-        AND r.transaction_id NOT IN (SELECT transaction_id FROM quarantine_rejected_sales_header)
-    """)
-    
-    # Rule 3: Invalid customer_id
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_header 
-        (transaction_id, customer_id, store_id, transaction_date, total_amount, rejection_reason)
-        SELECT r.transaction_id, r.customer_id, r.store_id, r.transaction_date, r.total_amount, 
-               'REJECTED: Invalid customer_id'
-        FROM raw_store_sales_header r
-        LEFT JOIN staging_customer_details c ON r.customer_id = c.customer_id
-        WHERE c.customer_id IS NULL
-        AND r.transaction_id NOT IN (SELECT transaction_id FROM quarantine_rejected_sales_header)
-    """)
-    
-    # Rule 4: Invalid transaction_date
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_header 
-        (transaction_id, customer_id, store_id, transaction_date, total_amount, rejection_reason)
-        SELECT transaction_id, customer_id, store_id, transaction_date, total_amount, 
-               'REJECTED: Invalid transaction_date'
-        FROM raw_store_sales_header
-        WHERE (transaction_date IS NULL OR transaction_date = '')
-        AND transaction_id NOT IN (SELECT transaction_id FROM quarantine_rejected_sales_header)
-    """)
-    
-    # Rule 5: Invalid total_amount
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_header 
-        (transaction_id, customer_id, store_id, transaction_date, total_amount, rejection_reason)
-        SELECT transaction_id, customer_id, store_id, transaction_date, total_amount, 
-               'REJECTED: Invalid total_amount'
-        FROM raw_store_sales_header
-        WHERE total_amount <= 0
-        AND transaction_id NOT IN (SELECT transaction_id FROM quarantine_rejected_sales_header)
-    """)
-    
-    # Rule 10: Total mismatch
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_header 
-        (transaction_id, customer_id, store_id, transaction_date, total_amount, rejection_reason)
-        SELECT h.transaction_id, h.customer_id, h.store_id, h.transaction_date, h.total_amount, 
-               'REJECTED: Total amount mismatch'
-        FROM raw_store_sales_header h
-        LEFT JOIN (
-            SELECT transaction_id, SUM(line_item_amount) as total
-            FROM raw_store_sales_line_items
-            GROUP BY transaction_id
-        ) l ON h.transaction_id = l.transaction_id
-        WHERE ABS(h.total_amount - COALESCE(l.total, 0)) > 0.01
-        AND h.transaction_id NOT IN (SELECT transaction_id FROM quarantine_rejected_sales_header)
-    """)
-    
-    conn.commit()
-    conn.close()
-    print("[OK] Header validation complete")
+def validate_headers(db_path, since_batch=None, conn=None):
+    """Validate header records (rules 1-5 and 10 in a single scan)"""
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        rejected = apply_rules(cursor, HEADER_VALIDATION, since_batch)
+        conn.commit()
+    print(f"[OK] Header validation complete ({rejected} rejected)")
 
-def validate_line_items(db_path):
-    """Validate line item records"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Rule 6: Missing product_id
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_line_items 
-        (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount, rejection_reason)
-        SELECT line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount, 
-               'REJECTED: Missing product_id'
-        FROM raw_store_sales_line_items
-        WHERE (product_id IS NULL OR product_id = '')
-        AND line_item_id NOT IN (SELECT line_item_id FROM quarantine_rejected_sales_line_items)
-    """)
-    
-    # Rule 7: Invalid product_id
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_line_items 
-        (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount, rejection_reason)
-        SELECT r.line_item_id, r.transaction_id, r.product_id, r.promotion_id, r.quantity, r.line_item_amount, 
-               'REJECTED: Invalid product_id'
-        FROM raw_store_sales_line_items r
-        LEFT JOIN staging_products p ON r.product_id = p.product_id
-        WHERE p.product_id IS NULL
-        AND r.line_item_id NOT IN (SELECT line_item_id FROM quarantine_rejected_sales_line_items)
-    """)
-    
-    # Rule 8: Invalid line_item_amount
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_line_items 
-        (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount, rejection_reason)
-        SELECT line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount, 
-               'REJECTED: Invalid line_item_amount'
-        FROM raw_store_sales_line_items
-        WHERE line_item_amount <= 0
-        AND line_item_id NOT IN (SELECT line_item_id FROM quarantine_rejected_sales_line_items)
-    """)
-    
-    # Rule 9: Invalid transaction_id
-    cursor.execute("""
-        INSERT INTO quarantine_rejected_sales_line_items 
-        (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount, rejection_reason)
-        SELECT r.line_item_id, r.transaction_id, r.product_id, r.promotion_id, r.quantity, r.line_item_amount, 
-               'REJECTED: Invalid transaction_id'
-        FROM raw_store_sales_line_items r
-        LEFT JOIN raw_store_sales_header h ON r.transaction_id = h.transaction_id
-        WHERE h.transaction_id IS NULL
-        AND r.line_item_id NOT IN (SELECT line_item_id FROM quarantine_rejected_sales_line_items)
-    """)
-    
-    conn.commit()
-    conn.close()
-    print("[OK] Line items validation complete")
+def validate_line_items(db_path, since_batch=None, conn=None):
+    """Validate line item records (rules 6-9 in a single scan)"""
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        rejected = apply_rules(cursor, LINE_ITEM_VALIDATION, since_batch)
+        conn.commit()
+    print(f"[OK] Line items validation complete ({rejected} rejected)")
 
-def route_valid_data(db_path):
-    """Route valid data to staging"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Clear staging tables
-    cursor.execute("DELETE FROM staging_store_sales_line_items")
-    cursor.execute("DELETE FROM staging_store_sales_header")
-    
-    # Route valid headers
-    cursor.execute("""
-        INSERT INTO staging_store_sales_header 
+def route_valid_data_incremental(cursor, since_batch):
+    """Append valid rows of load batches after since_batch to staging"""
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO staging_store_sales_header 
         (transaction_id, customer_id, store_id, transaction_date, total_amount)
-        SELECT transaction_id, customer_id, store_id, transaction_date, total_amount
-        FROM raw_store_sales_header
-        WHERE transaction_id NOT IN (SELECT transaction_id FROM quarantine_rejected_sales_header)
+        SELECT r.transaction_id, r.customer_id, r.store_id, r.transaction_date, r.total_amount
+        FROM raw_store_sales_header r
+        WHERE NOT EXISTS (
+            SELECT 1 FROM quarantine_rejected_sales_header q WHERE q.transaction_id = r.transaction_id
+        )
+        {_batch_filter(since_batch, 'r.')}
     """)
+    headers = cursor.rowcount
     
-    # Route valid line items
-    cursor.execute("""
-        INSERT INTO staging_store_sales_line_items 
+    cursor.execute(f"""
+        INSERT OR IGNORE INTO staging_store_sales_line_items 
         (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount)
         SELECT r.line_item_id, r.transaction_id, r.product_id, r.promotion_id, r.quantity, r.line_item_amount
         FROM raw_store_sales_line_items r
-        WHERE r.line_item_id NOT IN (SELECT line_item_id FROM quarantine_rejected_sales_line_items)
-        AND r.transaction_id IN (SELECT transaction_id FROM staging_store_sales_header)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM quarantine_rejected_sales_line_items q WHERE q.line_item_id = r.line_item_id
+        )
+        AND EXISTS (
+            SELECT 1 FROM staging_store_sales_header h WHERE h.transaction_id = r.transaction_id
+        )
+        {_batch_filter(since_batch, 'r.')}
     """)
+    return headers, cursor.rowcount
+
+def route_valid_data(db_path, since_batch=None, retention=DEFAULT_STAGING_RETENTION, conn=None):
+    """Route valid data to staging (append only batches after since_batch when given)
+
+    A full route builds the next staging generation in shadow tables and swaps
+    it in atomically; readers never see empty or partially built staging.
+    """
+    if since_batch is not None:
+        with connection_scope(db_path, conn) as conn:
+            headers, line_items = route_valid_data_incremental(conn.cursor(), since_batch)
+            conn.commit()
+        print(f"[OK] Appended {headers} headers and {line_items} line items to staging")
+        return
+    
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        header_shadow, line_items_shadow = [create_shadow_table(conn, table) for table in STAGING_SALES_TABLES]
+        
+        # Route valid headers (anti-join probes the quarantine primary key); processed
+        # flags carry over from the live generation so accrual only sees new transactions
+        cursor.execute(f"""
+            INSERT INTO {header_shadow} 
+            (transaction_id, customer_id, store_id, transaction_date, total_amount, processed)
+            SELECT r.transaction_id, r.customer_id, r.store_id, r.transaction_date, r.total_amount,
+                   COALESCE(s.processed, 0)
+            FROM raw_store_sales_header r
+            LEFT JOIN staging_store_sales_header s ON s.transaction_id = r.transaction_id
+            WHERE r.transaction_id IS NOT NULL
+            AND NOT EXISTS (
+                SELECT 1 FROM quarantine_rejected_sales_header q WHERE q.transaction_id = r.transaction_id
+            )
+        """)
+        
+        # Route valid line items
+        cursor.execute(f"""
+            INSERT INTO {line_items_shadow} 
+            (line_item_id, transaction_id, product_id, promotion_id, quantity, line_item_amount)
+            SELECT r.line_item_id, r.transaction_id, r.product_id, r.promotion_id, r.quantity, r.line_item_amount
+            FROM raw_store_sales_line_items r
+            WHERE NOT EXISTS (
+                SELECT 1 FROM quarantine_rejected_sales_line_items q WHERE q.line_item_id = r.line_item_id
+            )
+            AND EXISTS (
+                SELECT 1 FROM {header_shadow} h WHERE h.transaction_id = r.transaction_id
+            )
+        """)
+        conn.commit()
+        
+        generation = swap_shadow_tables(conn, STAGING_SALES_TABLES, retention)
+    print(f"[OK] Valid data routed to staging (generation {generation} retired, {retention} kept)")
+
+def execute_append(db_path, chunksize=None, verbose=False, conn=None):
+    """Ingest only files new since the last run and validate/route just their batch"""
+    with connection_scope(db_path, conn) as conn:
+        batch_id = next_batch_id(conn)
+        since_batch = get_watermark(conn, 'route')
+        
+        print("\n[Step 1] Loading changed master data...")
+        load_master_data(db_path, batch_id=batch_id, conn=conn)
+        
+        print("\n[Step 2] Appending new raw sales files...")
+        if not append_raw_sales_data(db_path, batch_id, chunksize or DEFAULT_CHUNK_SIZE, verbose=verbose, conn=conn):
+            print("\n[OK] No new sales files, nothing to validate")
+            return db_path
+        
+        print(f"\n[Step 3-6] Normalizing, validating and routing batches after {since_batch}...")
+        normalize_data(db_path, since_batch=since_batch, conn=conn)
+        validate_headers(db_path, since_batch=since_batch, conn=conn)
+        validate_line_items(db_path, since_batch=since_batch, conn=conn)
+        route_valid_data(db_path, since_batch=since_batch, conn=conn)
+        
+        set_watermark(conn, 'route', batch_id)
+        conn.commit()
+        create_indexes(conn)
     
-    conn.commit()
-    conn.close()
-    print("[OK] Valid data routed to staging")
+    print("\n[OK] Use Case 1 completed successfully")
+    return db_path
 
-def execute(db_path):
-    """Execute Use Case 1 pipeline"""
+def execute(db_path, chunksize=None, keep_schema=False, prevalidate=False, append=False,
+            parallel=False, workers=None, retention=DEFAULT_STAGING_RETENTION, verbose=False, conn=None):
+    """Execute Use Case 1 pipeline (chunksize streams the raw sales load, verbose reports every chunk)"""
     print("\n" + "="*60)
     print("USE CASE 1: DATA INGESTION AND QUALITY VALIDATION")
     print("="*60)
     
+    if append:
+        if prevalidate or parallel:
+            raise ValueError("append mode validates in SQL and cannot be combined with prevalidate")
+        return execute_append(db_path, chunksize, verbose=verbose, conn=conn)
+    
     # Load master data
     print("\n[Step 1] Loading master data...")
-    load_master_data(db_path)
+    load_master_data(db_path, keep_schema=keep_schema, conn=conn)
     
-    # Load raw sales data
-    print("\n[Step 2] Loading raw sales data...")
-    load_raw_sales_data(db_path)
-    
-    # Normalize data
-    print("\n[Step 3] Normalizing data...")
-    normalize_data(db_path)
-    
-    # Validate headers
-    print("\n[Step 4] Validating header data...")
-    validate_headers(db_path)
-    
-    # Validate line items
-    print("\n[Step 5] Validating line items...")
-    validate_line_items(db_path)
+    if parallel:
+        # Every store/day partition is pre-validated in its own worker process
+        print("\n[Step 2-5] Pre-validating sales partitions in parallel...")
+        parallel_prevalidate_raw_sales_data(db_path, workers=workers,
+                                            chunksize=chunksize or DEFAULT_CHUNK_SIZE, conn=conn)
+    elif prevalidate:
+        # Normalize and validate in memory; only valid rows reach the raw tables
+        print("\n[Step 2-5] Pre-validating raw sales data in memory...")
+        prevalidate_raw_sales_data(db_path, chunksize or DEFAULT_CHUNK_SIZE, verbose=verbose, conn=conn)
+    else:
+        # Load raw sales data
+        print("\n[Step 2] Loading raw sales data...")
+        load_raw_sales_data(db_path, chunksize=chunksize, keep_schema=keep_schema, verbose=verbose, conn=conn)
+        
+        # Normalize data
+        print("\n[Step 3] Normalizing data...")
+        normalize_data(db_path, conn=conn)
+        
+        # Validate headers
+        print("\n[Step 4] Validating header data...")
+        validate_headers(db_path, conn=conn)
+        
+        # Validate line items
+        print("\n[Step 5] Validating line items...")
+        validate_line_items(db_path, conn=conn)
     
     # Route valid data
     print("\n[Step 6] Routing valid data to staging...")
-    route_valid_data(db_path)
+    route_valid_data(db_path, retention=retention, conn=conn)
+    
+    # Build quarantine/staging indexes now that the bulk writes are done
+    with connection_scope(db_path, conn) as index_conn:
+        create_indexes(index_conn)
+        # Everything on disk is now loaded: later append runs start from here
+        reset_manifest(index_conn, partitioned=parallel)
+        set_watermark(index_conn, 'route', 0)
+        index_conn.commit()
     
     print("\n[OK] Use Case 1 completed successfully")
     return db_path
-
@@ -0,0 +1,203 @@
+"""Parallel partitioned ingestion for Use Case 1
+
+Production sales arrive as one header and one line-item file per store per
+day (``store_sales_header_<partition>.csv``). Every partition is parsed and
+pre-validated in a worker process; the validated frames travel back through a
+bounded queue to the parent, the only process that writes to SQLite. Workers
+never contend for the database lock, and a slow writer throttles the parsers
+instead of letting parsed frames pile up in memory.
+
+A partition is expected to be self-contained: header totals (rule 10) and
+orphan line items (rule 9) are checked against the same partition. Line item
+ids are not: an id that an earlier partition (in suffix order) already holds,
+or that repeats within its partition, is re-keyed from the partition's own
+range of negative ids, the same way split rows are, so raw and quarantine get
+the same ids and no generated id can collide with a later delivery.
+"""
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from queue import Empty
+import numpy as np
+import pandas as pd
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.database import connection_scope, restore_declared_schema, drop_indexes, create_indexes
+from common.data_loader import discover_partitions, RAW_SALES_FILES, DEFAULT_CHUNK_SIZE
+from usecase1.validation_rules import HEADER_VALIDATION, LINE_ITEM_VALIDATION
+from usecase1.prevalidation import (
+    load_master_keys, split_multi_product_rows, validated_chunks, write_validated, _scan_line_items,
+    plan_rekeys, rekey_duplicate_ids,
+)
+
+DEFAULT_QUEUE_SIZE = 8
+
+SPECS = {spec['source']: spec for spec in (HEADER_VALIDATION, LINE_ITEM_VALIDATION)}
+
+# Master-data keys, shipped to each worker once by the pool initializer
+_master_ctx = {}
+
+def _init_worker(master_ctx):
+    """Pool initializer: keep the master-data keys for every task of this worker"""
+    _master_ctx.update(master_ctx)
+
+def _scan_partition(paths, chunksize):
+    """Line-item totals, split row count and line_item_ids of one partition"""
+    line_items_path = paths.get('raw_store_sales_line_items')
+    if line_items_path is None:
+        return pd.Series(dtype=float), 0, pd.Series(dtype='Int64')
+    return _scan_line_items(line_items_path, chunksize)
+
+def _prevalidate_partition(partition, paths, line_totals, rekey_rows, first_new_id, chunksize, queue):
+    """Worker: validate one partition and queue its frames for the writer"""
+    started = time.perf_counter()
+    rows = 0
+    try:
+        ctx = dict(_master_ctx, line_totals=line_totals)
+        
+        header_ids = []
+        def collect_header_ids(chunk):
+            header_ids.append(chunk['transaction_id'])
+            return chunk
+        
+        # The partition's id range: re-keyed rows first, then split rows
+        next_rekey_id = first_new_id
+        next_split_id = first_new_id - len(rekey_rows)
+        rows_read = 0
+        def split_products(chunk):
+            nonlocal next_rekey_id, next_split_id, rows_read
+            chunk, next_rekey_id = rekey_duplicate_ids(chunk, rekey_rows, rows_read, next_rekey_id)
+            rows_read += len(chunk)
+            chunk, next_split_id = split_multi_product_rows(chunk, next_split_id)
+            return chunk
+        
+        steps = [
+            (HEADER_VALIDATION, collect_header_ids),
+            (LINE_ITEM_VALIDATION, split_products),
+        ]
+        for spec, prepare in steps:
+            csv_path = paths.get(spec['source'])
+            if spec is LINE_ITEM_VALIDATION:
+                ctx['header_ids'] = pd.Index(pd.concat(header_ids).unique()) if header_ids else pd.Index([])
+            if csv_path is None:
+                continue
+            for valid, quarantined in validated_chunks(csv_path, spec, ctx, chunksize, prepare):
+                queue.put(('rows', spec['source'], valid, quarantined))
+                rows += len(valid) + len(quarantined)
+        
+        stats = {'pid': os.getpid(), 'rows': rows, 'seconds': time.perf_counter() - started}
+        queue.put(('done', partition, stats))
+    except Exception:
+        queue.put(('error', partition, traceback.format_exc()))
+        raise
+
+def _next_message(queue, futures):
+    """Next queued message; fails fast if a worker died without reporting"""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise future.exception()
+
+def _drain(queue, futures):
+    """Discard queued frames until every worker has stopped, so none blocks on a full queue"""
+    for future in futures:
+        future.cancel()
+    while not all(future.done() for future in futures):
+        try:
+            queue.get(timeout=0.1)
+        except Empty:
+            pass
+
+def report_worker_throughput(worker_stats):
+    """Print rows/sec per worker process"""
+    for pid, stats in sorted(worker_stats.items()):
+        rate = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else float('inf')
+        print(f"  [WORKER {pid}] {stats['partitions']} partitions, {stats['rows']} rows ({rate:,.0f} rows/sec)")
+
+def parallel_prevalidate_raw_sales_data(db_path, data_dir=None, workers=None, chunksize=DEFAULT_CHUNK_SIZE,
+                                        queue_size=DEFAULT_QUEUE_SIZE, conn=None):
+    """Pre-validate every sales partition in a process pool and load valid rows through one writer"""
+    partitions = discover_partitions(data_dir)
+    if not partitions:
+        print("[WARN] No sales partitions found")
+        return {}
+    workers = workers or os.cpu_count() or 1
+    totals = {table: [0, 0] for table in SPECS}
+    worker_stats = {}
+    started = time.perf_counter()
+    
+    with connection_scope(db_path, conn) as conn:
+        restore_declared_schema(conn, list(RAW_SALES_FILES))
+        master_ctx = load_master_keys(conn)
+        
+        with multiprocessing.Manager() as manager, \
+                ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                    initargs=(master_ctx,)) as pool:
+            # Pass 1: rule 10 totals, the rows whose line_item_id an earlier partition or row
+            # already holds and a disjoint range of negative ids per partition for those and
+            # its split rows; workers only get the row numbers to re-key
+            scans = list(pool.map(_scan_partition, partitions.values(), repeat(chunksize)))
+            next_line_item_id = -1
+            
+            queue = manager.Queue(maxsize=queue_size)
+            futures = []
+            claimed = np.empty(0, dtype=np.int64)
+            rekeyed = 0
+            for (partition, paths), (line_totals, split_rows, ids) in zip(partitions.items(), scans):
+                rekey_rows = plan_rekeys(ids, claimed)
+                claimed = np.union1d(claimed, ids.dropna().to_numpy(dtype=np.int64))
+                futures.append(pool.submit(_prevalidate_partition, partition, paths, line_totals, rekey_rows,
+                                           next_line_item_id, chunksize, queue))
+                next_line_item_id -= len(rekey_rows) + split_rows
+                rekeyed += len(rekey_rows)
+            if rekeyed:
+                print(f"[OK] Re-keying {rekeyed} line items whose line_item_id repeats across or within partitions")
+            
+            try:
+                drop_indexes(conn, RAW_SALES_FILES)
+                for table in RAW_SALES_FILES:
+                    conn.execute(f"DELETE FROM {table}")
+                
+                pending = len(futures)
+                while pending:
+                    message = _next_message(queue, futures)
+                    if message[0] == 'rows':
+                        _, table, valid, quarantined = message
+                        written = write_validated(conn, SPECS[table], valid, quarantined)
+                        totals[table][0] += written[0]
+                        totals[table][1] += written[1]
+                    elif message[0] == 'done':
+                        _, partition, stats = message
+                        pending -= 1
+                        worker = worker_stats.setdefault(stats['pid'], {'partitions': 0, 'rows': 0, 'seconds': 0.0})
+                        worker['partitions'] += 1
+                        worker['rows'] += stats['rows']
+                        worker['seconds'] += stats['seconds']
+                        print(f"  [PARTITION {partition or '(base)'}] {stats['rows']} rows by worker {stats['pid']}")
+                    else:
+                        raise RuntimeError(f"Partition {message[1] or '(base)'} failed:\n{message[2]}")
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                _drain(queue, futures)
+                raise
+        
+        create_indexes(conn, RAW_SALES_FILES)
+    
+    elapsed = time.perf_counter() - started
+    rows = sum(valid + rejected for valid, rejected in totals.values())
+    report_worker_throughput(worker_stats)
+    print(f"[OK] Pre-validated {len(partitions)} partitions with {workers} workers "
+          f"({rows / elapsed if elapsed > 0 else 0:,.0f} rows/sec overall)")
+    
+    headers = tuple(totals[HEADER_VALIDATION['source']])
+    line_items = tuple(totals[LINE_ITEM_VALIDATION['source']])
+    print(f"[OK] Pre-validated header: {headers[0]} valid, {headers[1]} rejected")
+    print(f"[OK] Pre-validated line items: {line_items[0]} valid, {line_items[1]} rejected")
+    return {'header': headers, 'line_items': line_items, 'workers': worker_stats}
@@ -0,0 +1,163 @@
+"""Declarative data quality rules for Use Case 1
+
+Each rule is data: its number, the rejection reason, a SQL predicate over
+the joined source row and the same check as a vectorized mask over a
+DataFrame chunk. All rules of a table are evaluated in a single scan that
+folds them into a rejection bitmask (bit ``rule_no - 1``), so adding a rule
+adds a predicate, not another pass over the raw table.
+
+Values the raw loader could not parse are NULL in their typed column and kept
+as text in ``unparsed_values``, which rules 11 and 12 quarantine.
+
+The vectorized masks take the chunk and a lookup context holding the
+master-data keys (``store_ids``, ``customer_ids``, ``product_ids``), every
+header ``transaction_id`` in the feed and the per-transaction line-item
+totals (``line_totals``).
+"""
+import numpy as np
+import pandas as pd
+
+HEADER_COLUMNS = ['transaction_id', 'customer_id', 'store_id', 'transaction_date', 'total_amount']
+LINE_ITEM_COLUMNS = ['line_item_id', 'transaction_id', 'product_id', 'promotion_id', 'quantity', 'line_item_amount']
+
+# Raw and quarantine column with the text of values the loader could not parse
+UNPARSED_COLUMN = 'unparsed_values'
+
+HEADER_VALIDATION = {
+    'source': 'raw_store_sales_header',
+    'quarantine': 'quarantine_rejected_sales_header',
+    'columns': HEADER_COLUMNS,
+    'row_columns': HEADER_COLUMNS + [UNPARSED_COLUMN],
+    # Lookups are index probes per row, so validating a batch never scans the whole feed
+    'joins': """
+        LEFT JOIN staging_stores s ON r.store_id = s.store_id
+        LEFT JOIN staging_customer_details c ON r.customer_id = c.customer_id
+    """,
+    'rules': [
+        {'rule_no': 1, 'reason': 'Missing or NULL customer_id',
+         'predicate': "r.customer_id IS NULL OR r.customer_id = '' OR r.customer_id = 'INVALID'",
+         'mask': lambda df, ctx: _is_blank(df['customer_id']) | (df['customer_id'] == 'INVALID')},
+        {'rule_no': 2, 'reason': 'Invalid store_id',
+         'predicate': "s.store_id IS NULL",
+         'mask': lambda df, ctx: ~df['store_id'].isin(ctx['store_ids'])},
+        {'rule_no': 3, 'reason': 'Invalid customer_id',
+         'predicate': "c.customer_id IS NULL",
+         'mask': lambda df, ctx: ~df['customer_id'].isin(ctx['customer_ids'])},
+        {'rule_no': 4, 'reason': 'Invalid transaction_date',
+         'predicate': "r.transaction_date IS NULL OR r.transaction_date = ''",
+         'mask': lambda df, ctx: _is_blank(df['transaction_date'])},
+        {'rule_no': 5, 'reason': 'Invalid total_amount',
+         'predicate': "r.total_amount <= 0",
+         'mask': lambda df, ctx: df['total_amount'] <= 0},
+        {'rule_no': 10, 'reason': 'Total amount mismatch',
+         'predicate': """ABS(r.total_amount - COALESCE((
+             SELECT SUM(li.line_item_amount)
+             FROM raw_store_sales_line_items li
+             WHERE li.transaction_id = r.transaction_id
+         ), 0)) > 0.01""",
+         'mask': lambda df, ctx: (
+             df['total_amount'] - df['transaction_id'].map(ctx['line_totals']).fillna(0)
+         ).abs() > 0.01},
+        {'rule_no': 11, 'reason': 'Unparseable value',
+         'predicate': "r.unparsed_values IS NOT NULL",
+         'mask': lambda df, ctx: _has_unparsed(df)},
+    ],
+}
+
+LINE_ITEM_VALIDATION = {
+    'source': 'raw_store_sales_line_items',
+    'quarantine': 'quarantine_rejected_sales_line_items',
+    'columns': LINE_ITEM_COLUMNS,
+    'row_columns': LINE_ITEM_COLUMNS + [UNPARSED_COLUMN],
+    'joins': """
+        LEFT JOIN staging_products p ON r.product_id = p.product_id
+        LEFT JOIN raw_store_sales_header h ON r.transaction_id = h.transaction_id
+    """,
+    'rules': [
+        {'rule_no': 6, 'reason': 'Missing product_id',
+         'predicate': "r.product_id IS NULL OR r.product_id = ''",
+         'mask': lambda df, ctx: _is_blank(df['product_id'])},
+        {'rule_no': 7, 'reason': 'Invalid product_id',
+         'predicate': "p.product_id IS NULL",
+         'mask': lambda df, ctx: ~df['product_id'].isin(ctx['product_ids'])},
+        {'rule_no': 8, 'reason': 'Invalid line_item_amount',
+         'predicate': "r.line_item_amount <= 0",
+         'mask': lambda df, ctx: df['line_item_amount'] <= 0},
+        {'rule_no': 9, 'reason': 'Invalid transaction_id',
+         'predicate': "h.transaction_id IS NULL",
+         'mask': lambda df, ctx: ~df['transaction_id'].isin(ctx['header_ids'])},
+        {'rule_no': 12, 'reason': 'Unparseable value',
+         'predicate': "r.unparsed_values IS NOT NULL",
+         'mask': lambda df, ctx: _has_unparsed(df)},
+    ],
+}
+
+def _is_blank(column):
+    """NULL or empty string"""
+    return column.isna() | (column.astype('string') == '').fillna(False)
+
+def _has_unparsed(df):
+    """Rows holding a value that did not parse"""
+    if UNPARSED_COLUMN not in df:
+        return np.zeros(len(df), dtype=bool)
+    return df[UNPARSED_COLUMN].notna()
+
+def rule_bit(rule_no):
+    """Bit for a rule in the rejection mask"""
+    return 1 << (rule_no - 1)
+
+def decode_rejection_mask(mask, spec):
+    """List the rule numbers set in a rejection mask"""
+    return [rule['rule_no'] for rule in spec['rules'] if mask & rule_bit(rule['rule_no'])]
+
+def build_validation_sql(spec, since_batch=None):
+    """Build the single-scan INSERT that quarantines every row failing any rule
+
+    With since_batch only raw rows of later load batches are validated.
+    """
+    mask_expr = ' | '.join(
+        f"(COALESCE(({rule['predicate']}), 0) << {rule['rule_no'] - 1})"
+        for rule in spec['rules']
+    )
+    reasons_expr = ' || '.join(
+        f"CASE WHEN rejection_mask & {rule_bit(rule['rule_no'])} THEN '; {rule['reason']}' ELSE '' END"
+        for rule in spec['rules']
+    )
+    batch_filter = f"WHERE r.load_batch_id > {int(since_batch)}" if since_batch is not None else ""
+    columns = ', '.join(spec['row_columns'])
+    source_columns = ', '.join(f"r.{col}" for col in spec['row_columns'])
+    
+    # INSERT OR IGNORE keeps rows quarantined by an earlier run instead of a NOT IN anti-join
+    return f"""
+        INSERT OR IGNORE INTO {spec['quarantine']}
+        ({columns}, rejection_reason, rejection_mask)
+        SELECT {columns}, 'REJECTED: ' || SUBSTR({reasons_expr}, 3), rejection_mask
+        FROM (
+            SELECT {source_columns}, {mask_expr} AS rejection_mask
+            FROM {spec['source']} r
+            {spec['joins']}
+            {batch_filter}
+        )
+        WHERE rejection_mask <> 0
+    """
+
+def apply_rules(cursor, spec, since_batch=None):
+    """Evaluate all rules of a spec in one scan, returns rows quarantined"""
+    cursor.execute(build_validation_sql(spec, since_batch))
+    return cursor.rowcount
+
+def compute_rejection_mask(df, spec, ctx):
+    """Evaluate all rules of a spec over a DataFrame chunk as one int64 bitmask"""
+    mask = np.zeros(len(df), dtype=np.int64)
+    for rule in spec['rules']:
+        failed = np.asarray(rule['mask'](df, ctx), dtype=bool)
+        mask |= failed.astype(np.int64) << (rule['rule_no'] - 1)
+    return mask
+
+def rejection_reasons(mask, spec):
+    """Vectorized rejection_reason text for each row of a rejection mask"""
+    reasons = pd.Series('', index=range(len(mask)), dtype=object)
+    for rule in spec['rules']:
+        failed = (mask & rule_bit(rule['rule_no'])) != 0
+        reasons = reasons + np.where(failed, f"; {rule['reason']}", '')
+    return 'REJECTED: ' + reasons.str[2:]
@@ -3,89 +3,175 @@ import sqlite3
 import sys
 import os
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from common.database import get_connection
+from common.database import get_connection, connection_scope, get_watermark, set_watermark
+from usecase2.lift_intervals import lift_intervals
 
-def calculate_promotion_effectiveness(db_path):
-    """Calculate promotion effectiveness and rank top 3"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+# Tables whose full reload invalidates the running promotion aggregates
+AGGREGATE_SOURCES = ['staging_store_sales_line_items', 'staging_products']
+
+AGGREGATE_TABLES = ['daily_category_sales', 'promotion_sales_totals', 'category_baseline_totals']
+
+def sales_lift_percentage(baseline_sales, promoted_sales):
+    """Lift of promoted over baseline sales in percent, 0 without a baseline"""
+    if baseline_sales > 0:
+        return ((promoted_sales - baseline_sales) / baseline_sales) * 100
+    return 0.0
+
+def reset_aggregates_after_reload(conn):
+    """Empty the running aggregates if a source table was reloaded since they were built"""
+    reloads = {table: get_watermark(conn, f'reload:{table}') for table in AGGREGATE_SOURCES}
+    if all(count <= get_watermark(conn, f'promotion_aggregates:{table}') for table, count in reloads.items()):
+        return False
     
-    # Clear previous results
-    cursor.execute("DELETE FROM promotion_effectiveness")
+    for table in AGGREGATE_TABLES:
+        conn.execute(f"DELETE FROM {table}")
+    conn.execute("UPDATE staging_store_sales_line_items SET aggregated = 0 WHERE aggregated != 0")
+    for table, count in reloads.items():
+        set_watermark(conn, f'promotion_aggregates:{table}', count)
+    return True
+
+def update_promotion_aggregates(conn):
+    """Fold line items not aggregated yet into the running totals, returns line items folded"""
+    cursor = conn.cursor()
+    if reset_aggregates_after_reload(conn):
+        print("[OK] Staging was reloaded, rebuilding promotion aggregates")
     
-    # Calculate baseline sales (non-promoted items) by category
+    # New line items are found through the partial index on aggregated = 0
+    cursor.execute("DROP TABLE IF EXISTS temp.new_line_items")
     cursor.execute("""
-        CREATE TEMP TABLE baseline_sales AS
-        SELECT 
+        CREATE TEMP TABLE new_line_items AS
+        SELECT
+            li.line_item_id,
             p.product_category as category,
-            SUM(li.quantity) as total_quantity,
-            SUM(li.line_item_amount) as total_revenue,
-            COUNT(DISTINCT li.product_id) as product_count
+            COALESCE(li.promotion_id, '') as promotion_id,
+            h.transaction_day as sale_day,
+            li.quantity,
+            li.line_item_amount
         FROM staging_store_sales_line_items li
-        JOIN staging_products p ON li.product_id = p.product_id
-        WHERE li.promotion_id IS NULL
-        GROUP BY p.product_category
+        JOIN staging_store_sales_header h ON li.transaction_id = h.transaction_id
+        LEFT JOIN staging_products p ON li.product_id = p.product_id
+        WHERE li.aggregated = 0
     """)
+    folded = cursor.execute("SELECT COUNT(*) FROM temp.new_line_items").fetchone()[0]
     
-    # Calculate promoted sales by promotion and category
     cursor.execute("""
-        CREATE TEMP TABLE promoted_sales AS
-        SELECT 
-            li.promotion_id,
-            pd.promotion_name,
-            p.product_category as category,
-            SUM(li.quantity) as total_quantity,
-            SUM(li.line_item_amount) as total_revenue
-        FROM staging_store_sales_line_items li
-        JOIN staging_products p ON li.product_id = p.product_id
-        JOIN staging_promotion_details pd ON li.promotion_id = pd.promotion_id
-        WHERE li.promotion_id IS NOT NULL
-        GROUP BY li.promotion_id, pd.promotion_name, p.product_category
+        INSERT INTO daily_category_sales
+        (category, promotion_id, sale_day, total_quantity, total_revenue, item_count, revenue_squares)
+        SELECT category, promotion_id, sale_day, SUM(quantity), SUM(line_item_amount),
+               COUNT(line_item_amount), SUM(line_item_amount * line_item_amount)
+        FROM temp.new_line_items
+        WHERE category IS NOT NULL AND sale_day IS NOT NULL
+        GROUP BY category, promotion_id, sale_day
+        ON CONFLICT(category, promotion_id, sale_day) DO UPDATE SET
+            total_quantity = total_quantity + excluded.total_quantity,
+            total_revenue = total_revenue + excluded.total_revenue,
+            item_count = item_count + excluded.item_count,
+            revenue_squares = revenue_squares + excluded.revenue_squares
+    """)
+    cursor.execute("""
+        INSERT INTO promotion_sales_totals
+        (promotion_id, category, total_quantity, total_revenue, item_count, revenue_squares)
+        SELECT promotion_id, category, SUM(quantity), SUM(line_item_amount),
+               COUNT(line_item_amount), SUM(line_item_amount * line_item_amount)
+        FROM temp.new_line_items
+        WHERE category IS NOT NULL AND promotion_id != ''
+        GROUP BY promotion_id, category
+        ON CONFLICT(promotion_id, category) DO UPDATE SET
+            total_quantity = total_quantity + excluded.total_quantity,
+            total_revenue = total_revenue + excluded.total_revenue,
+            item_count = item_count + excluded.item_count,
+            revenue_squares = revenue_squares + excluded.revenue_squares
     """)
-    
-    # Calculate sales lift for each promotion
     cursor.execute("""
-        INSERT INTO promotion_effectiveness 
-        (promotion_id, promotion_name, category, baseline_sales, promoted_sales, sales_lift_percentage)
-        SELECT 
-            ps.promotion_id,
-            ps.promotion_name,
-            ps.category,
-            COALESCE(bs.total_revenue, 0) as baseline_sales,
-            ps.total_revenue as promoted_sales,
-            CASE 
-                WHEN COALESCE(bs.total_revenue, 0) > 0 
-                THEN ((ps.total_revenue - COALESCE(bs.total_revenue, 0)) / bs.total_revenue) * 100
-                ELSE 0
-            END as sales_lift_percentage
-        FROM promoted_sales ps
-        LEFT JOIN baseline_sales bs ON ps.category = bs.category
+        INSERT INTO category_baseline_totals (category, total_quantity, total_revenue, item_count, revenue_squares)
+        SELECT category, SUM(quantity), SUM(line_item_amount),
+               COUNT(line_item_amount), SUM(line_item_amount * line_item_amount)
+        FROM temp.new_line_items
+        WHERE category IS NOT NULL AND promotion_id = ''
+        GROUP BY category
+        ON CONFLICT(category) DO UPDATE SET
+            total_quantity = total_quantity + excluded.total_quantity,
+            total_revenue = total_revenue + excluded.total_revenue,
+            item_count = item_count + excluded.item_count,
+            revenue_squares = revenue_squares + excluded.revenue_squares
     """)
+    cursor.execute("""
+        UPDATE staging_store_sales_line_items SET aggregated = 1
+        WHERE line_item_id IN (SELECT line_item_id FROM temp.new_line_items)
+    """)
+    cursor.execute("DROP TABLE IF EXISTS temp.new_line_items")
+    conn.commit()
+    return folded
+
+def rank_promotions(conn):
+    """Rebuild promotion_effectiveness from the running totals, returns the top 3"""
+    conn.create_function('sales_lift_percentage', 2, sales_lift_percentage, deterministic=True)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM promotion_effectiveness")
     
-    # Rank promotions by sales lift
+    # The baseline is the category's non-promoted sales outside the promotion's date
+    # window: the running category total minus one key range of daily_category_sales
+    # (rounded to cents, so a window covering every sale leaves 0 rather than float residue)
     cursor.execute("""
-        UPDATE promotion_effectiveness
-        SET rank = (
-            SELECT COUNT(*) + 1
-            FROM promotion_effectiveness p2
-            WHERE p2.sales_lift_percentage > promotion_effectiveness.sales_lift_percentage
+        INSERT INTO promotion_effectiveness
+        (promotion_id, promotion_name, category, baseline_sales, promoted_sales, sales_lift_percentage, rank)
+        WITH lift AS (
+            SELECT
+                ps.promotion_id,
+                pd.promotion_name,
+                ps.category,
+                ROUND(COALESCE(bt.total_revenue, 0) - COALESCE((
+                    SELECT SUM(w.total_revenue)
+                    FROM daily_category_sales w
+                    WHERE w.category = ps.category AND w.promotion_id = ''
+                      AND w.sale_day BETWEEN pd.start_day AND pd.end_day
+                ), 0), 2) as baseline_sales,
+                ps.total_revenue as promoted_sales
+            FROM promotion_sales_totals ps
+            JOIN staging_promotion_details pd ON ps.promotion_id = pd.promotion_id
+            LEFT JOIN category_baseline_totals bt ON ps.category = bt.category
+        ),
+        scored AS (
+            SELECT *, sales_lift_percentage(baseline_sales, promoted_sales) as sales_lift_percentage
+            FROM lift
         )
+        SELECT
+            promotion_id,
+            promotion_name,
+            category,
+            baseline_sales,
+            promoted_sales,
+            sales_lift_percentage,
+            RANK() OVER (ORDER BY sales_lift_percentage DESC) as rank
+        FROM scored
     """)
     
     # Get top 3 promotions
     cursor.execute("""
-        SELECT promotion_id, promotion_name, category, baseline_sales, promoted_sales, 
+        SELECT promotion_id, promotion_name, category, baseline_sales, promoted_sales,
                sales_lift_percentage, rank
         FROM promotion_effectiveness
-        ORDER BY sales_lift_percentage DESC
+        ORDER BY rank
         LIMIT 3
     """)
-    
     top_promotions = cursor.fetchall()
-    
     conn.commit()
-    conn.close()
+    return top_promotions
+
+def calculate_promotion_effectiveness(db_path, conn=None):
+    """Calculate promotion effectiveness and rank top 3"""
+    with connection_scope(db_path, conn) as conn:
+        folded = update_promotion_aggregates(conn)
+        top_promotions = rank_promotions(conn)
+        lift_intervals(conn)
+        intervals = {
+            (promotion_id, category): (lower, upper)
+            for promotion_id, category, lower, upper in conn.execute(
+                "SELECT promotion_id, category, lift_ci_lower, lift_ci_upper FROM promotion_effectiveness"
+            )
+        }
     
+    print(f"[OK] Folded {folded} new line items into promotion aggregates")
     print("[OK] Promotion effectiveness analysis complete")
     print("\nTop 3 Most Effective Promotions:")
     print("-" * 80)
@@ -96,17 +182,21 @@ def calculate_promotion_effectiveness(db_path):
         print(f"  Baseline Sales: ${baseline:.2f}")
         print(f"  Promoted Sales: ${promoted:.2f}")
         print(f"  Sales Lift: {lift:.2f}%")
+        lower, upper = intervals.get((promo_id, category), (None, None))
+        if lower is not None:
+            print(f"  95% CI: [{lower:.2f}%, {upper:.2f}%]")
+        else:
+            print("  95% CI: insufficient data")
         print()
     
     return top_promotions
 
-def execute(db_path):
+def execute(db_path, conn=None):
     """Execute Use Case 2 pipeline"""
     print("\n" + "="*60)
     print("USE CASE 2: REAL-TIME PROMOTION EFFECTIVENESS ANALYZER")
     print("="*60)
     
-    results = calculate_promotion_effectiveness(db_path)
+    results = calculate_promotion_effectiveness(db_path, conn=conn)
     print("\n[OK] Use Case 2 completed successfully")
     return results
-
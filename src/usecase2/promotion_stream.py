@@ -0,0 +1,243 @@
+"""Use Case 2: Streaming promotion leaderboard
+
+Consumes line-item events appended to a local feed file, one per line:
+
+    transaction_date,product_id,promotion_id,quantity,line_item_amount
+
+(promotion_id empty when the item was not promoted). Revenue counters per
+promotion and category, per category and per category and day stay in memory;
+every publish interval the top-K promotions by lift (same formula and
+date-windowed baseline as calculate_promotion_effectiveness) are picked with a
+heap and written to promotion_stream_leaderboard in the same transaction that
+checkpoints the counters and the feed offset, so a restart resumes exactly
+where the last publish left off. A feed that shrinks below the checkpointed
+offset (truncated or rotated) is read again from the start; a line longer
+than READ_SIZE is skipped and counted as rejected.
+"""
+import os
+import sys
+import time
+import heapq
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.database import connection_scope
+from usecase2.promotion_analyzer import sales_lift_percentage
+
+DEFAULT_TOP_K = 3
+DEFAULT_PUBLISH_INTERVAL = 60.0
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Bytes read from the feed per poll; a trailing partial line is left for the next read,
+# a line that does not fit is skipped
+READ_SIZE = 1 << 20
+
+def feed_name(feed_path):
+    """Key of a feed in the checkpoint tables"""
+    return os.path.abspath(feed_path)
+
+def load_reference_data(conn):
+    """Product categories (keyed by the raw feed bytes) and promotion details"""
+    categories = {
+        product_id.encode(): category
+        for product_id, category in conn.execute(
+            "SELECT product_id, product_category FROM staging_products WHERE product_category IS NOT NULL"
+        )
+    }
+    promotions = {
+        promotion_id: (name, start_date, end_date)
+        for promotion_id, name, start_date, end_date in conn.execute(
+            "SELECT promotion_id, promotion_name, start_date, end_date FROM staging_promotion_details"
+        )
+    }
+    return categories, promotions
+
+def new_counters():
+    """Empty in-memory counters (events and rejected count this process only)"""
+    return {'promoted': {}, 'baseline': {}, 'daily': {}, 'events': 0, 'rejected': 0}
+
+def load_checkpoint(conn, feed_path):
+    """Counters and feed offset of the last checkpoint (empty counters at offset 0 before it)"""
+    feed = feed_name(feed_path)
+    counters = new_counters()
+    rows = conn.execute("""
+        SELECT counter, counter_key, category, revenue FROM promotion_stream_counters WHERE feed = ?
+    """, (feed,))
+    for counter, key, category, revenue in rows:
+        if counter == 'promoted':
+            counters['promoted'][(key, category)] = revenue
+        elif counter == 'baseline':
+            counters['baseline'][category] = revenue
+        else:
+            counters['daily'].setdefault(category, {})[key] = revenue
+    row = conn.execute("SELECT byte_offset FROM promotion_stream_state WHERE feed = ?", (feed,)).fetchone()
+    return counters, row[0] if row else 0
+
+def read_events(feed, offset):
+    """Complete event lines after offset, returns (lines, new offset, oversized lines skipped)"""
+    feed.seek(offset)
+    data = feed.read(READ_SIZE)
+    end = data.rfind(b'\n') + 1
+    if end or len(data) < READ_SIZE:
+        return data[:end].splitlines(), offset + end, 0
+
+    # A full read without a newline: skip the oversized line once its newline arrives
+    skipped = len(data)
+    while True:
+        data = feed.read(READ_SIZE)
+        newline = data.find(b'\n')
+        if newline >= 0:
+            return [], offset + skipped + newline + 1, 1
+        if not data:
+            return [], offset, 0
+        skipped += len(data)
+
+def feed_replaced(feed, feed_path, offset):
+    """Whether the feed was truncated below offset or rotated to a new file"""
+    opened = os.fstat(feed.fileno())
+    try:
+        current = os.stat(feed_path)
+    except FileNotFoundError:
+        return False
+    return opened.st_size < offset or (current.st_ino, current.st_dev) != (opened.st_ino, opened.st_dev)
+
+def apply_events(counters, lines, categories):
+    """Add a batch of event lines to the counters"""
+    promoted = counters['promoted']
+    baseline = counters['baseline']
+    daily = counters['daily']
+    rejected = 0
+    for line in lines:
+        try:
+            transaction_date, product_id, promotion_id, _, amount = line.split(b',')
+            amount = float(amount)
+            category = categories[product_id]
+        except (ValueError, KeyError):
+            rejected += 1
+            continue
+        if promotion_id:
+            key = (promotion_id.decode(), category)
+            promoted[key] = promoted.get(key, 0.0) + amount
+        else:
+            baseline[category] = baseline.get(category, 0.0) + amount
+            days = daily.get(category)
+            if days is None:
+                days = daily[category] = {}
+            sale_date = transaction_date[:10].decode()
+            days[sale_date] = days.get(sale_date, 0.0) + amount
+    counters['events'] += len(lines) - rejected
+    counters['rejected'] += rejected
+
+def top_promotions(counters, promotions, top_k=DEFAULT_TOP_K):
+    """Top-K (promotion, category) rows by lift, with RANK() style ranks"""
+    rows = []
+    for (promotion_id, category), promoted_sales in counters['promoted'].items():
+        if promotion_id not in promotions:
+            continue
+        name, start_date, end_date = promotions[promotion_id]
+        # Baseline: the category's non-promoted sales outside the promotion's date window
+        # (empty without both dates, as BETWEEN NULL is in the batch analyzer),
+        # rounded to cents so a window holding every sale leaves 0, not float residue
+        window = 0.0
+        if start_date is not None and end_date is not None:
+            window = sum(revenue for day, revenue in counters['daily'].get(category, {}).items()
+                         if start_date <= day <= end_date)
+        baseline_sales = round(counters['baseline'].get(category, 0.0) - window, 2)
+        rows.append((promotion_id, name, category, baseline_sales, promoted_sales,
+                     sales_lift_percentage(baseline_sales, promoted_sales)))
+
+    # Ties at the cut-off keep their shared rank, as RANK() does
+    lifts = heapq.nlargest(top_k, (row[5] for row in rows))
+    if not lifts:
+        return []
+    leaders = sorted((row for row in rows if row[5] >= lifts[-1]), key=lambda row: (-row[5], row[0], row[2]))
+    ranks = [1 + sum(1 for other in leaders if other[5] > row[5]) for row in leaders]
+    return [row + (rank,) for row, rank in zip(leaders, ranks) if rank <= top_k]
+
+def publish(conn, feed_path, counters, offset, leaderboard):
+    """Checkpoint counters and feed offset and replace the published leaderboard, in one transaction"""
+    feed = feed_name(feed_path)
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM promotion_stream_counters WHERE feed = ?", (feed,))
+    cursor.executemany("""
+        INSERT INTO promotion_stream_counters (feed, counter, counter_key, category, revenue)
+        VALUES (?, ?, ?, ?, ?)
+    """, [
+        *((feed, 'promoted', promotion_id, category, revenue)
+          for (promotion_id, category), revenue in counters['promoted'].items()),
+        *((feed, 'baseline', '', category, revenue) for category, revenue in counters['baseline'].items()),
+        *((feed, 'daily', day, category, revenue)
+          for category, days in counters['daily'].items() for day, revenue in days.items()),
+    ])
+    cursor.execute("""
+        INSERT INTO promotion_stream_state (feed, byte_offset, updated_timestamp)
+        VALUES (?, ?, CURRENT_TIMESTAMP)
+        ON CONFLICT(feed) DO UPDATE SET
+            byte_offset = excluded.byte_offset,
+            updated_timestamp = excluded.updated_timestamp
+    """, (feed, offset))
+
+    cursor.execute("DELETE FROM promotion_stream_leaderboard WHERE feed = ?", (feed,))
+    cursor.executemany("""
+        INSERT INTO promotion_stream_leaderboard
+        (feed, promotion_id, promotion_name, category, baseline_sales, promoted_sales, sales_lift_percentage, rank)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(feed, *row) for row in leaderboard])
+    conn.commit()
+
+def format_leaderboard(leaderboard):
+    """One-line leaderboard: rank, promotion and lift"""
+    return " | ".join(f"#{rank} {promotion_id}/{category} {lift:+.1f}%"
+                      for promotion_id, _, category, _, _, lift, rank in leaderboard) or "(no promotions yet)"
+
+def run_leaderboard_service(db_path, feed_path, top_k=DEFAULT_TOP_K, interval=DEFAULT_PUBLISH_INTERVAL,
+                            poll_interval=DEFAULT_POLL_INTERVAL, follow=True, conn=None):
+    """Tail a line-item feed and publish the top-K promotions every interval seconds
+
+    With follow=False the service stops at the end of the feed; otherwise it
+    runs until interrupted. A final publish checkpoints whatever was consumed.
+    """
+    with connection_scope(db_path, conn) as conn:
+        categories, promotions = load_reference_data(conn)
+        counters, offset = load_checkpoint(conn, feed_path)
+        print(f"[OK] Streaming {feed_path} from byte {offset}, top {top_k} every {interval:g}s")
+
+        started = time.perf_counter()
+        next_publish = time.monotonic() + interval
+        leaderboard = []
+        feed = open(feed_path, 'rb')
+        try:
+            if os.fstat(feed.fileno()).st_size < offset:
+                print(f"[WARN] {feed_path} is shorter than the checkpoint, reading it from the start")
+                offset = 0
+            while True:
+                lines, offset, oversized = read_events(feed, offset)
+                counters['rejected'] += oversized
+                apply_events(counters, lines, categories)
+                if time.monotonic() >= next_publish:
+                    leaderboard = top_promotions(counters, promotions, top_k)
+                    publish(conn, feed_path, counters, offset, leaderboard)
+                    print(f"  [LEADERBOARD] {format_leaderboard(leaderboard)}")
+                    next_publish = time.monotonic() + interval
+                if not lines and not oversized:
+                    if feed_replaced(feed, feed_path, offset):
+                        # Events already consumed stay counted; the new file starts at byte 0
+                        print(f"[WARN] {feed_path} was truncated or rotated, reading it from the start")
+                        feed.close()
+                        feed = open(feed_path, 'rb')
+                        offset = 0
+                        continue
+                    if not follow:
+                        break
+                    time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            print("\n[OK] Stopping leaderboard service")
+        finally:
+            feed.close()
+            leaderboard = top_promotions(counters, promotions, top_k)
+            publish(conn, feed_path, counters, offset, leaderboard)
+        elapsed = time.perf_counter() - started
+
+    events = counters['events']
+    print(f"  [LEADERBOARD] {format_leaderboard(leaderboard)}")
+    print(f"[OK] Consumed {events} events ({events / elapsed if elapsed > 0 else 0:,.0f} events/sec), "
+          f"{counters['rejected']} rejected, checkpointed at byte {offset}")
+    return leaderboard
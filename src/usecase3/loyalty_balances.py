@@ -0,0 +1,190 @@
+"""Loyalty balance snapshots and point-in-time lookups for Use Case 3
+
+Every accrual run materializes each customer's balance as of the newest
+ledger date in loyalty_balance_snapshots. A balance as of any date is then
+the nearest snapshot plus (or minus) the short ledger tail between the two
+dates, read from the covering (customer_id, transaction_date, points_earned)
+index instead of replaying the whole history. Transactions that arrive late,
+dated before snapshots already taken, make every snapshot from their date on
+be taken again.
+
+Compaction folds ledger rows up to a snapshot into one row per customer
+(rule_applied 'Compacted'), keeping every balance sum intact. The ids of the
+folded transactions move to compacted_transactions, so accrual and the
+notification outbox still see them as paid. Before the compaction cutoff
+balances resolve at snapshot granularity.
+
+Dates passed in are compared with the ledger's 'YYYY-MM-DD HH:MM:SS' text;
+a bare date means the end of that day.
+"""
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.database import connection_scope
+
+COMPACTED_RULE = 'Compacted'
+
+def end_of_day(value):
+    """Ledger timestamp of an as-of date: a bare date (or date object) is the end of that day"""
+    if value is None:
+        return None
+    text = str(value)
+    return f"{text} 23:59:59" if len(text) == 10 else text
+
+def stale_snapshot_dates(cursor):
+    """Snapshot dates missing ledger rows accrued after the newest snapshot was taken
+
+    A late row (accrued after the newest snapshot, dated at or before some
+    snapshot) invalidates every snapshot from its date on. Snapshots up to the
+    last compaction are left alone: the folded ledger can not rebuild them.
+    """
+    earliest = cursor.execute("""
+        SELECT MIN(transaction_date) FROM loyalty_point_transactions
+        WHERE accrued_timestamp >= (SELECT MAX(created_timestamp) FROM loyalty_balance_snapshots)
+          AND rule_applied IS NOT ?
+    """, (COMPACTED_RULE,)).fetchone()[0]
+    if earliest is None:
+        return []
+    cursor.execute("""
+        SELECT DISTINCT snapshot_date FROM loyalty_balance_snapshots
+        WHERE snapshot_date >= ?
+          AND snapshot_date > COALESCE((SELECT MAX(compacted_through) FROM loyalty_ledger_compactions), '')
+        ORDER BY snapshot_date
+    """, (earliest,))
+    return [row[0] for row in cursor.fetchall()]
+
+def snapshot_balances(db_path, snapshot_date=None, conn=None):
+    """Snapshot every customer's balance as of snapshot_date (default: newest ledger date)
+
+    Earlier snapshots that late-arriving ledger rows made stale are taken again.
+    """
+    snapshot_date = end_of_day(snapshot_date)
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        if snapshot_date is None:
+            snapshot_date = cursor.execute("SELECT MAX(transaction_date) FROM loyalty_point_transactions").fetchone()[0]
+            if snapshot_date is None:
+                return None
+        
+        stale = [date for date in stale_snapshot_dates(cursor) if date != snapshot_date]
+        for date in stale + [snapshot_date]:
+            # Live balance minus whatever was accrued after the snapshot date
+            cursor.execute("""
+                INSERT OR REPLACE INTO loyalty_balance_snapshots (customer_id, snapshot_date, balance)
+                SELECT c.customer_id, ?, c.total_loyalty_points - COALESCE(tail.points, 0)
+                FROM staging_customer_details c
+                LEFT JOIN (
+                    SELECT customer_id, SUM(points_earned) AS points
+                    FROM loyalty_point_transactions
+                    WHERE transaction_date > ?
+                    GROUP BY customer_id
+                ) tail ON tail.customer_id = c.customer_id
+            """, (date, date))
+        conn.commit()
+    
+    if stale:
+        print(f"[OK] Re-snapshotted {len(stale)} earlier snapshot dates after late-arriving transactions")
+    print(f"[OK] Snapshotted {cursor.rowcount} loyalty balances as of {snapshot_date}")
+    return snapshot_date
+
+def _ledger_points(cursor, customer_id, after=None, through=None):
+    """Points a customer accrued with after < transaction_date <= through"""
+    query = "SELECT COALESCE(SUM(points_earned), 0) FROM loyalty_point_transactions WHERE customer_id = ?"
+    params = [customer_id]
+    if after is not None:
+        query += " AND transaction_date > ?"
+        params.append(after)
+    if through is not None:
+        query += " AND transaction_date <= ?"
+        params.append(through)
+    return cursor.execute(query, params).fetchone()[0]
+
+def balance_as_of(db_path, customer_id, as_of, conn=None):
+    """A customer's loyalty balance as of a date, None for unknown customers"""
+    as_of = end_of_day(as_of)
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        compacted_through = cursor.execute(
+            "SELECT MAX(compacted_through) FROM loyalty_ledger_compactions"
+        ).fetchone()[0]
+        
+        # Nearest snapshot at or before as_of, plus the ledger tail since
+        earlier = cursor.execute("""
+            SELECT snapshot_date, balance FROM loyalty_balance_snapshots
+            WHERE customer_id = ? AND snapshot_date <= ?
+            ORDER BY snapshot_date DESC LIMIT 1
+        """, (customer_id, as_of)).fetchone()
+        if earlier is not None:
+            snapshot_date, balance = earlier
+            if compacted_through is not None and as_of < compacted_through:
+                return balance
+            return balance + _ledger_points(cursor, customer_id, after=snapshot_date, through=as_of)
+        
+        # Otherwise walk back from the next snapshot (or the live balance)
+        later = cursor.execute("""
+            SELECT snapshot_date, balance FROM loyalty_balance_snapshots
+            WHERE customer_id = ? AND snapshot_date > ?
+            ORDER BY snapshot_date LIMIT 1
+        """, (customer_id, as_of)).fetchone()
+        if later is not None:
+            snapshot_date, balance = later
+            return balance - _ledger_points(cursor, customer_id, after=as_of, through=snapshot_date)
+        
+        live = cursor.execute(
+            "SELECT total_loyalty_points FROM staging_customer_details WHERE customer_id = ?", (customer_id,)
+        ).fetchone()
+        if live is None:
+            return None
+        return live[0] - _ledger_points(cursor, customer_id, after=as_of)
+
+def compact_ledger(db_path, before, conn=None):
+    """Fold ledger rows up to the newest snapshot at or before `before`, returns rows folded"""
+    before = end_of_day(before)
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        cutoff = cursor.execute(
+            "SELECT MAX(snapshot_date) FROM loyalty_balance_snapshots WHERE snapshot_date <= ?", (before,)
+        ).fetchone()[0]
+        if cutoff is None:
+            print(f"[WARN] No balance snapshot at or before {before}, nothing compacted")
+            return 0
+        
+        try:
+            cursor.execute("DROP TABLE IF EXISTS temp.compacted_ledger")
+            cursor.execute("""
+                CREATE TEMP TABLE compacted_ledger AS
+                SELECT customer_id, SUM(transaction_amount) AS transaction_amount,
+                       SUM(points_earned) AS points_earned, MAX(transaction_date) AS transaction_date,
+                       COUNT(*) AS rows_folded
+                FROM loyalty_point_transactions
+                WHERE transaction_date <= ?
+                GROUP BY customer_id
+            """, (cutoff,))
+            # Keep the folded ids: accrual must not pay these transactions again
+            cursor.execute("""
+                INSERT OR IGNORE INTO compacted_transactions (transaction_id, compacted_through)
+                SELECT transaction_id, ? FROM loyalty_point_transactions
+                WHERE transaction_date <= ? AND rule_applied IS NOT ?
+            """, (cutoff, cutoff, COMPACTED_RULE))
+            cursor.execute("DELETE FROM loyalty_point_transactions WHERE transaction_date <= ?", (cutoff,))
+            cursor.execute("""
+                INSERT INTO loyalty_point_transactions
+                (transaction_id, customer_id, transaction_amount, points_earned, rule_applied, transaction_date)
+                SELECT 'COMPACTED ' || ? || ' ' || COALESCE(customer_id, ''), customer_id, transaction_amount,
+                       points_earned, ?, transaction_date
+                FROM temp.compacted_ledger
+            """, (cutoff, COMPACTED_RULE))
+            folded = cursor.execute("SELECT COALESCE(SUM(rows_folded), 0) FROM temp.compacted_ledger").fetchone()[0]
+            cursor.execute("""
+                INSERT OR REPLACE INTO loyalty_ledger_compactions (compacted_through, rows_folded)
+                VALUES (?, ?)
+            """, (cutoff, folded))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.execute("DROP TABLE IF EXISTS temp.compacted_ledger")
+    
+    print(f"[OK] Compacted {folded} ledger rows through {cutoff}")
+    return folded
@@ -1,91 +1,296 @@
 """Use Case 3: Loyalty Point Calculation Engine"""
 import sqlite3
+from contextlib import nullcontext
 from datetime import datetime
 import sys
 import os
+import pandas as pd
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from common.database import get_connection
+from common.database import (
+    get_connection, connection_scope, create_indexes, get_watermark, set_watermark, weekday_of_day_key,
+)
+from usecase3.loyalty_balances import snapshot_balances, compact_ledger
+from usecase3.parallel_accrual import create_accrual_pool, compute_points_sharded
+from usecase3.rule_compiler import (
+    load_loyalty_rules, compile_rules, compute_points, rule_applies_on,
+)
 
-def calculate_loyalty_points(db_path):
-    """Calculate and accrue loyalty points for transactions"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Clear previous loyalty transactions
-    cursor.execute("DELETE FROM loyalty_point_transactions")
-    
-    # Get all unprocessed transactions
-    cursor.execute("""
-        SELECT h.transaction_id, h.customer_id, h.total_amount, h.transaction_date
-        FROM staging_store_sales_header h
-        WHERE h.processed = 0
-    """)
-    
-    transactions = cursor.fetchall()
+DEFAULT_ACCRUAL_BATCH_SIZE = 50000
+
+def reapply_ledger_balances(conn):
+    """Add the ledger back onto customer balances after the customer master was reloaded
+
+    A reload resets total_loyalty_points to the source system's opening
+    balances; the append-only ledger keeps the points accrued since. Costs one
+    pass over the ledger, and only on runs that reloaded customers.
+    """
+    reloads = get_watermark(conn, 'reload:staging_customer_details')
+    if reloads <= get_watermark(conn, 'loyalty_balances'):
+        return 0
     
-    # Get loyalty rules
+    cursor = conn.cursor()
     cursor.execute("""
-        SELECT rule_id, rule_name, points_per_unit_spend, min_spend_threshold, bonus_points
-        FROM staging_loyalty_rules
-        ORDER BY min_spend_threshold DESC
+        UPDATE staging_customer_details
+        SET total_loyalty_points = total_loyalty_points + ledger.points,
+            last_purchase_date = ledger.last_date
+        FROM (
+            SELECT customer_id, SUM(points_earned) AS points, MAX(transaction_date) AS last_date
+            FROM loyalty_point_transactions
+            GROUP BY customer_id
+        ) ledger
+        WHERE staging_customer_details.customer_id = ledger.customer_id
     """)
-    
-    rules = cursor.fetchall()
-    
-    total_points_updated = 0
-    
-    for txn_id, customer_id, total_amount, txn_date in transactions:
-        # Find applicable rule (highest threshold that is met)
-        applicable_rule = None
-        for rule_id, rule_name, points_per_unit, min_spend, bonus_points in rules:
-            if total_amount >= min_spend:
-                applicable_rule = (rule_id, rule_name, points_per_unit, min_spend, bonus_points)
-                break
+    set_watermark(conn, 'loyalty_balances', reloads)
+    conn.commit()
+    return cursor.rowcount
+
+def calculate_loyalty_points(db_path, conn=None):
+    """Calculate and accrue loyalty points for transactions"""
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        reapply_ledger_balances(conn)
         
-        if applicable_rule:
-            rule_id, rule_name, points_per_unit, min_spend, bonus_points = applicable_rule
+        # Get all unprocessed transactions
+        cursor.execute("""
+            SELECT h.transaction_id, h.customer_id, h.total_amount, h.transaction_date, h.transaction_day
+            FROM staging_store_sales_header h
+            WHERE h.processed = 0
+        """)
+        
+        transactions = cursor.fetchall()
+        
+        # Get loyalty rules
+        rules = load_loyalty_rules(conn)
+        rules.sort(key=lambda rule: (-rule['min_spend_threshold'], rule['rule_id']))
+        rules = [
+            (rule['rule_id'], rule['rule_name'], rule['points_per_unit_spend'],
+             rule['min_spend_threshold'], rule['bonus_points'], rule)
+            for rule in rules
+        ]
+        
+        total_points_updated = 0
+        
+        for txn_id, customer_id, total_amount, txn_date, txn_day in transactions:
+            # Find applicable rule (highest threshold that is met on this weekday)
+            weekday = None if txn_day is None else weekday_of_day_key(txn_day)
+            applicable_rule = None
+            for rule_id, rule_name, points_per_unit, min_spend, bonus_points, rule in rules:
+                if total_amount >= min_spend and rule_applies_on(rule, weekday):
+                    applicable_rule = (rule_id, rule_name, points_per_unit, min_spend, bonus_points)
+                    break
             
-            # Calculate points
-            base_points = int(total_amount * points_per_unit)
-            total_points_earned = base_points + bonus_points
+            if applicable_rule:
+                rule_id, rule_name, points_per_unit, min_spend, bonus_points = applicable_rule
+                
+                # Calculate points
+                base_points = int(total_amount * points_per_unit)
+                total_points_earned = base_points + bonus_points
+                
+                # Record transaction (the ledger is append-only: accrue each transaction once)
+                cursor.execute("""
+                    INSERT OR IGNORE INTO loyalty_point_transactions
+                    (transaction_id, customer_id, transaction_amount, points_earned, rule_applied, transaction_date)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, (txn_id, customer_id, total_amount, total_points_earned, rule_name, txn_date))
+                
+                # Update customer's total points
+                if cursor.rowcount == 1:
+                    cursor.execute("""
+                        UPDATE staging_customer_details
+                        SET total_loyalty_points = total_loyalty_points + ?,
+                            last_purchase_date = ?
+                        WHERE customer_id = ?
+                    """, (total_points_earned, txn_date, customer_id))
+                    
+                    total_points_updated += 1
             
-            # Record transaction
+            # Mark transaction as processed
             cursor.execute("""
-                INSERT INTO loyalty_point_transactions
-                (transaction_id, customer_id, transaction_amount, points_earned, rule_applied, transaction_date)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (txn_id, customer_id, total_amount, total_points_earned, rule_name, txn_date))
-            
-            # Update customer's total points
-            cursor.execute("""
-                UPDATE staging_customer_details
-                SET total_loyalty_points = total_loyalty_points + ?,
-                    last_purchase_date = ?
-                WHERE customer_id = ?
-            """, (total_points_earned, txn_date, customer_id))
-            
-            total_points_updated += 1
+                UPDATE staging_store_sales_header
+                SET processed = 1
+                WHERE transaction_id = ?
+            """, (txn_id,))
         
-        # Mark transaction as processed
-        cursor.execute("""
-            UPDATE staging_store_sales_header
-            SET processed = 1
-            WHERE transaction_id = ?
-        """, (txn_id,))
+        conn.commit()
     
-    conn.commit()
-    conn.close()
+    print(f"[OK] Processed {total_points_updated} transactions and updated loyalty points")
+    return total_points_updated
+
+def accrue_loyalty_points(db_path, batch_size=DEFAULT_ACCRUAL_BATCH_SIZE, workers=None, conn=None):
+    """Calculate and accrue loyalty points set-based, a batch of transactions at a time
+
+    Same rule choice and points as calculate_loyalty_points, but the rules of
+    a whole batch are matched with array operations (see rule_compiler) and
+    the batch is written with three statements: the ledger, each customer once
+    with their summed points (last_purchase_date becomes their latest
+    transaction in the batch) and the processed flags.
+    
+    The ledger is append-only: transactions already in it are never accrued
+    again. Unprocessed headers are found through a partial index, so a run
+    costs the size of the delta, and every committed batch checkpoints the
+    run in loyalty_accrual_runs.
+    
+    With workers, each batch is priced in a process pool, sharded by
+    customer_id (see parallel_accrual); writes stay in this connection.
+    """
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        create_indexes(conn, ['staging_store_sales_header', 'loyalty_point_transactions'])
+        reapply_ledger_balances(conn)
+        
+        # A run that never finished stopped mid-way; its committed batches stay accrued
+        cursor.execute("UPDATE loyalty_accrual_runs SET status = 'interrupted' WHERE status = 'running'")
+        cursor.execute("INSERT INTO loyalty_accrual_runs (status) VALUES ('running')")
+        run_id = cursor.lastrowid
+        conn.commit()
+        
+        cursor.execute("DROP TABLE IF EXISTS temp.loyalty_accrual")
+        cursor.execute("""
+            CREATE TEMP TABLE loyalty_accrual (
+                transaction_id TEXT PRIMARY KEY,
+                customer_id TEXT,
+                total_amount REAL,
+                transaction_date TEXT,
+                rule_name TEXT,
+                points_earned INTEGER
+            )
+        """)
+        
+        compiled = compile_rules(load_loyalty_rules(conn))
+        total_points_updated = 0
+        total_points = 0
+        last_transaction_id = ''
+        with (create_accrual_pool(compiled, workers) if workers else nullcontext()) as pool:
+            while True:
+                batch = pd.read_sql("""
+                    SELECT transaction_id, customer_id, total_amount, transaction_date, transaction_day
+                    FROM staging_store_sales_header
+                    WHERE processed = 0 AND transaction_id > ?
+                    ORDER BY transaction_id
+                    LIMIT ?
+                """, conn, params=(last_transaction_id, batch_size))
+                if batch.empty:
+                    break
+                
+                if pool is None:
+                    accrued = compute_points(compiled, batch)
+                else:
+                    accrued = compute_points_sharded(pool, batch, shards=workers)
+                accrued = accrued.astype(object).where(accrued.notna(), None)
+                cursor.execute("DELETE FROM temp.loyalty_accrual")
+                cursor.executemany("""
+                    INSERT INTO temp.loyalty_accrual
+                    (transaction_id, customer_id, total_amount, transaction_date, rule_name, points_earned)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                """, accrued[['transaction_id', 'customer_id', 'total_amount', 'transaction_date',
+                              'rule_name', 'points_earned']].itertuples(index=False, name=None))
+                
+                # Transactions already in the ledger, or folded by a compaction (e.g. after a
+                # staging rebuild), earn nothing twice
+                cursor.execute("""
+                    UPDATE temp.loyalty_accrual SET rule_name = NULL, points_earned = NULL
+                    WHERE transaction_id IN (SELECT transaction_id FROM loyalty_point_transactions)
+                    OR transaction_id IN (SELECT transaction_id FROM compacted_transactions)
+                """)
+                
+                cursor.execute("""
+                    INSERT INTO loyalty_point_transactions
+                    (transaction_id, customer_id, transaction_amount, points_earned, rule_applied, transaction_date, run_id)
+                    SELECT transaction_id, customer_id, total_amount, points_earned, rule_name, transaction_date, ?
+                    FROM temp.loyalty_accrual
+                    WHERE rule_name IS NOT NULL
+                """, (run_id,))
+                total_points_updated += cursor.rowcount
+                total_points += cursor.execute("""
+                    SELECT COALESCE(SUM(points_earned), 0) FROM temp.loyalty_accrual WHERE rule_name IS NOT NULL
+                """).fetchone()[0]
+                
+                cursor.execute("""
+                    UPDATE staging_customer_details
+                    SET total_loyalty_points = total_loyalty_points + accrued.points,
+                        last_purchase_date = accrued.last_date
+                    FROM (
+                        SELECT customer_id, SUM(points_earned) AS points, MAX(transaction_date) AS last_date
+                        FROM temp.loyalty_accrual
+                        WHERE rule_name IS NOT NULL
+                        GROUP BY customer_id
+                    ) accrued
+                    WHERE staging_customer_details.customer_id = accrued.customer_id
+                """)
+                
+                cursor.execute("""
+                    UPDATE staging_store_sales_header
+                    SET processed = 1
+                    WHERE transaction_id IN (SELECT transaction_id FROM temp.loyalty_accrual)
+                """)
+                
+                last_transaction_id = batch['transaction_id'].iloc[-1]
+                cursor.execute("""
+                    UPDATE loyalty_accrual_runs
+                    SET transactions_accrued = ?, points_accrued = ?, last_transaction_id = ?,
+                        checkpoint_timestamp = CURRENT_TIMESTAMP
+                    WHERE run_id = ?
+                """, (total_points_updated, total_points, last_transaction_id, run_id))
+                conn.commit()
+        
+        cursor.execute("DROP TABLE IF EXISTS temp.loyalty_accrual")
+        cursor.execute("""
+            UPDATE loyalty_accrual_runs SET status = 'completed', checkpoint_timestamp = CURRENT_TIMESTAMP
+            WHERE run_id = ?
+        """, (run_id,))
+        conn.commit()
     
     print(f"[OK] Processed {total_points_updated} transactions and updated loyalty points")
     return total_points_updated
 
-def execute(db_path):
-    """Execute Use Case 3 pipeline"""
+def check_accrual_determinism(db_path, workers, conn=None):
+    """Run serial and parallel accrual on in-memory copies and compare their results
+
+    Returns True when both produce the same ledger, customer balances and
+    processed flags. The database itself is not modified.
+    """
+    query = """
+        SELECT 'ledger', transaction_id, customer_id, points_earned, rule_applied FROM loyalty_point_transactions
+        UNION ALL
+        SELECT 'balance', customer_id, total_loyalty_points, last_purchase_date, NULL FROM staging_customer_details
+        UNION ALL
+        SELECT 'processed', transaction_id, processed, NULL, NULL FROM staging_store_sales_header
+    """
+    results = []
+    with connection_scope(db_path, conn) as conn:
+        for run_workers in (None, workers):
+            copy = sqlite3.connect(':memory:')
+            conn.backup(copy)
+            accrue_loyalty_points(None, workers=run_workers, conn=copy)
+            results.append(sorted(copy.execute(query).fetchall(), key=repr))
+            copy.close()
+    
+    deterministic = results[0] == results[1]
+    if deterministic:
+        print(f"[OK] Parallel accrual ({workers} workers) matches the serial run")
+    else:
+        differences = len(set(results[0]) ^ set(results[1]))
+        print(f"[WARN] Parallel accrual ({workers} workers) differs from the serial run in {differences} rows")
+    return deterministic
+
+def execute(db_path, bulk=True, compact_before=None, workers=None, check_determinism=False, conn=None):
+    """Execute Use Case 3 pipeline (bulk uses set-based accrual)"""
     print("\n" + "="*60)
     print("USE CASE 3: LOYALTY POINT CALCULATION ENGINE")
     print("="*60)
     
-    count = calculate_loyalty_points(db_path)
+    if workers and check_determinism and not check_accrual_determinism(db_path, workers, conn=conn):
+        raise RuntimeError("Parallel loyalty accrual is not deterministic, refusing to run it")
+    
+    if bulk:
+        count = accrue_loyalty_points(db_path, workers=workers, conn=conn)
+    else:
+        count = calculate_loyalty_points(db_path, conn=conn)
+    
+    # Materialize balances for point-in-time lookups, then fold old ledger rows if asked
+    snapshot_balances(db_path, conn=conn)
+    if compact_before:
+        compact_ledger(db_path, compact_before, conn=conn)
     print(f"\n[OK] Use Case 3 completed successfully - {count} transactions processed")
     return count
 
@@ -0,0 +1,123 @@
+"""Loyalty rule compiler for Use Case 3
+
+The rule table is compiled once per run into, for every weekday, a sorted
+array of the thresholds of the rules active on that day. Matching a batch of
+transactions is then one ``searchsorted`` per weekday: the highest threshold
+met wins (lowest rule_id among equal thresholds), as in the per-row loop.
+
+A rule's calendar comes from its ``applicable_days`` column (for example
+``'Sat,Sun'``); rules without a calendar apply every day. Transactions without a parseable
+date only match every-day rules. Weekdays come from the integer
+``transaction_day`` key when the transactions carry it.
+"""
+import numpy as np
+import pandas as pd
+from common.database import weekday_of_day_key
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+ALL_DAYS = (1 << len(WEEKDAYS)) - 1
+
+# Slot of the compiled rules used for transactions with an unknown weekday
+UNKNOWN_DAY = len(WEEKDAYS)
+
+TRANSACTION_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def parse_days(days):
+    """Weekday bitmask (bit 0 = Monday) of a 'Sat,Sun' style list, every day when empty"""
+    if days is None or (isinstance(days, float) and np.isnan(days)) or not str(days).strip():
+        return ALL_DAYS
+    mask = 0
+    for day in str(days).split(','):
+        day = day.strip()[:3].title()
+        if day not in WEEKDAYS:
+            raise ValueError(f"Unknown weekday in rule calendar: {days!r}")
+        mask |= 1 << WEEKDAYS.index(day)
+    return mask
+
+def rule_calendar(rule):
+    """Weekday bitmask of a rule"""
+    return parse_days(rule.get('applicable_days'))
+
+def rule_applies_on(rule, weekday):
+    """Whether a rule is active on a weekday (None when the date is unknown)"""
+    calendar = rule_calendar(rule)
+    if weekday is None:
+        return calendar == ALL_DAYS
+    return bool(calendar & (1 << weekday))
+
+def load_loyalty_rules(conn):
+    """Read the rule table as a list of dicts (applicable_days only if the table has it)"""
+    columns = ['rule_id', 'rule_name', 'points_per_unit_spend', 'min_spend_threshold', 'bonus_points']
+    if 'applicable_days' in [row[1] for row in conn.execute("PRAGMA table_info(staging_loyalty_rules)")]:
+        columns.append('applicable_days')
+    cursor = conn.execute(f"SELECT {', '.join(columns)} FROM staging_loyalty_rules ORDER BY rule_id")
+    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+def compile_rules(rules):
+    """Compile rules into per-weekday sorted threshold arrays"""
+    # Ascending threshold, descending rule_id: the last met entry is the winning rule
+    order = sorted(
+        (i for i, rule in enumerate(rules) if rule['min_spend_threshold'] is not None),
+        key=lambda i: (rules[i]['min_spend_threshold'], -rules[i]['rule_id']),
+    )
+    calendars = [rule_calendar(rule) for rule in rules]
+    
+    slots = []
+    for day in range(len(WEEKDAYS) + 1):
+        if day == UNKNOWN_DAY:
+            active = [i for i in order if calendars[i] == ALL_DAYS]
+        else:
+            active = [i for i in order if calendars[i] & (1 << day)]
+        thresholds = np.array([rules[i]['min_spend_threshold'] for i in active], dtype=float)
+        slots.append((thresholds, np.array(active, dtype=int)))
+    
+    return {
+        'rules': rules,
+        'slots': slots,
+        'rule_names': np.array([rule['rule_name'] for rule in rules], dtype=object),
+        'points_per_unit': np.array([rule['points_per_unit_spend'] for rule in rules], dtype=float),
+        'bonus_points': np.array([rule['bonus_points'] for rule in rules], dtype=float),
+    }
+
+def match_rules(compiled, amounts, weekdays):
+    """Index into compiled['rules'] of each transaction's rule, -1 where none applies"""
+    amounts = np.asarray(amounts, dtype=float)
+    weekdays = np.asarray(weekdays, dtype=int)
+    matched = np.full(len(amounts), -1, dtype=int)
+    
+    for day, (thresholds, rule_index) in enumerate(compiled['slots']):
+        if not len(thresholds):
+            continue
+        in_slot = (weekdays == day) & ~np.isnan(amounts)
+        if not in_slot.any():
+            continue
+        position = np.searchsorted(thresholds, amounts[in_slot], side='right') - 1
+        matched[in_slot] = np.where(position >= 0, rule_index[np.maximum(position, 0)], -1)
+    return matched
+
+def compute_points(compiled, transactions):
+    """Add rule_name and points_earned to a frame of transactions (None where no rule applies)"""
+    if 'transaction_day' in transactions:
+        weekdays = weekday_of_day_key(pd.to_numeric(transactions['transaction_day'], errors='coerce'))
+    else:
+        dates = pd.to_datetime(transactions['transaction_date'], format=TRANSACTION_DATE_FORMAT, errors='coerce')
+        weekdays = dates.dt.dayofweek
+    weekdays = weekdays.fillna(UNKNOWN_DAY).to_numpy(dtype=int)
+    amounts = pd.to_numeric(transactions['total_amount'], errors='coerce').to_numpy(dtype=float)
+    
+    matched = match_rules(compiled, amounts, weekdays)
+    if not compiled['rules']:
+        result = transactions.copy()
+        result['rule_name'] = None
+        result['points_earned'] = pd.Series(pd.NA, index=result.index, dtype='Int64')
+        return result
+    has_rule = matched >= 0
+    rule = np.maximum(matched, 0)
+    
+    # int() truncation toward zero, as in the per-row loop
+    points = np.trunc(amounts * compiled['points_per_unit'][rule]) + compiled['bonus_points'][rule]
+    
+    result = transactions.copy()
+    result['rule_name'] = np.where(has_rule, compiled['rule_names'][rule], None)
+    result['points_earned'] = pd.Series(np.where(has_rule, points, np.nan), index=result.index).astype('Int64')
+    return result
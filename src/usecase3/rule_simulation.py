@@ -0,0 +1,247 @@
+"""Loyalty rule what-if simulation and backfill for Use Case 3
+
+simulate_rule_sets prices the whole transaction history under one or more
+candidate rule sets, batch by batch (keyset pagination, so memory is bounded
+by the batch size), and reports points issued per rule set, customer segment
+and month. It only reads; the ledger and balances are left alone.
+
+backfill_loyalty_points recomputes the points of already accrued transactions
+under a rule set. Date-range chunks are priced in a process pool, each worker
+reading through its own connection, and the parent applies every chunk in one
+write transaction, committed once every chunk and the balance snapshot are
+written: ledger rows are rewritten and each customer's balance moves by the
+difference between new and old points. A failed chunk leaves nothing applied.
+"""
+import os
+import sys
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.database import connection_scope, create_indexes, get_db_path
+from usecase3.rule_compiler import compile_rules, compute_points, load_loyalty_rules
+from usecase3.loyalty_balances import snapshot_balances
+
+DEFAULT_SIMULATION_BATCH_SIZE = 100000
+DEFAULT_BACKFILL_CHUNK_DAYS = 30
+
+RULE_COLUMNS = ['rule_id', 'rule_name', 'points_per_unit_spend', 'min_spend_threshold', 'bonus_points',
+                'applicable_days']
+
+def load_rule_set(csv_path):
+    """Read a candidate loyalty_rules.csv as rule dicts"""
+    df = pd.read_csv(csv_path)
+    df = df[[col for col in RULE_COLUMNS if col in df.columns]]
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict('records')
+
+def _history_batches(conn, batch_size):
+    """Yield every staged transaction with its customer segment, batch_size rows at a time"""
+    segment_table = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_segments'"
+    ).fetchone()
+    segment = "COALESCE(cs.segment_name, c.segment_id, 'Unsegmented')" if segment_table else "'Unsegmented'"
+    segment_join = "LEFT JOIN customer_segments cs ON cs.customer_id = h.customer_id" if segment_table else ""
+    
+    last_transaction_id = ''
+    while True:
+        batch = pd.read_sql(f"""
+            SELECT h.transaction_id, h.customer_id, h.total_amount, h.transaction_date,
+                   h.transaction_day, h.transaction_month, {segment} AS segment
+            FROM staging_store_sales_header h
+            LEFT JOIN staging_customer_details c ON c.customer_id = h.customer_id
+            {segment_join}
+            WHERE h.transaction_id > ?
+            ORDER BY h.transaction_id
+            LIMIT ?
+        """, conn, params=(last_transaction_id, batch_size))
+        if batch.empty:
+            return
+        yield batch
+        last_transaction_id = batch['transaction_id'].iloc[-1]
+
+def simulate_rule_sets(db_path, rule_sets, batch_size=DEFAULT_SIMULATION_BATCH_SIZE, conn=None):
+    """Price the full history under each rule set, returns points per rule set, segment and month
+    
+    rule_sets maps a name to a list of rule dicts; 'current' is added with the
+    live rule table unless given.
+    """
+    with connection_scope(db_path, conn) as conn:
+        rule_sets = dict(rule_sets)
+        rule_sets.setdefault('current', load_loyalty_rules(conn))
+        compiled = {name: compile_rules(rules) for name, rules in rule_sets.items()}
+        
+        partials = []
+        for batch in _history_batches(conn, batch_size):
+            months = {month: f"{int(month) // 100:04d}-{int(month) % 100:02d}"
+                      for month in batch['transaction_month'].dropna().unique()}
+            batch['month'] = batch['transaction_month'].map(months).fillna('unknown')
+            for name, rules in compiled.items():
+                priced = compute_points(rules, batch)
+                priced['rule_set'] = name
+                priced['rewarded'] = priced['points_earned'].notna()
+                partials.append(
+                    priced.groupby(['rule_set', 'segment', 'month'], dropna=False)
+                    .agg(transactions=('transaction_id', 'size'), rewarded=('rewarded', 'sum'),
+                         points=('points_earned', 'sum'))
+                )
+            # Fold partial aggregates as we go so memory stays bounded by the batch
+            partials = [pd.concat(partials).groupby(level=[0, 1, 2]).sum()]
+    
+    columns = ['rule_set', 'segment', 'month', 'transactions', 'rewarded', 'points']
+    if not partials:
+        return pd.DataFrame(columns=columns)
+    report = partials[0].reset_index()[columns]
+    report['points'] = report['points'].astype('int64')
+    
+    print("\nLoyalty rule simulation (points issued):")
+    print("-" * 60)
+    for name, points in report.groupby('rule_set')['points'].sum().items():
+        print(f"  {name:<30} {points:>12,}")
+    return report.sort_values(['rule_set', 'segment', 'month']).reset_index(drop=True)
+
+def _date_chunks(start, end, chunk_days):
+    """[from, to) transaction_date ranges of chunk_days covering start through the day of end"""
+    stop = pd.Timestamp(end).normalize() + pd.Timedelta(days=1)
+    bounds = pd.date_range(pd.Timestamp(start).normalize(), stop, freq=f'{chunk_days}D')
+    edges = [start] + [bound.strftime('%Y-%m-%d %H:%M:%S') for bound in bounds
+             if pd.Timestamp(start) < bound < stop]
+    edges.append(stop.strftime('%Y-%m-%d %H:%M:%S'))
+    return list(zip(edges[:-1], edges[1:]))
+
+def _epoch(timestamp):
+    """Unix seconds of a stored timestamp, as in the transaction_epoch key"""
+    return int(pd.Timestamp(timestamp).timestamp())
+
+# Compiled rules of the backfill, shipped to each worker once by the pool initializer
+_backfill_rules = {}
+
+def _init_backfill_worker(compiled):
+    """Pool initializer: keep the compiled rules for every chunk of this worker"""
+    _backfill_rules.update(compiled)
+
+def _price_date_range(db_path, date_from, date_to):
+    """Worker: new and old points of accrued transactions dated in [date_from, date_to)"""
+    # Reads through its own connection; the parent holds the only write connection
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    try:
+        transactions = pd.read_sql("""
+            SELECT h.transaction_id, h.customer_id, h.total_amount, h.transaction_date, h.transaction_day,
+                   COALESCE(l.points_earned, 0) AS old_points
+            FROM staging_store_sales_header h
+            LEFT JOIN loyalty_point_transactions l ON l.transaction_id = h.transaction_id
+            WHERE h.processed = 1 AND h.transaction_epoch >= ? AND h.transaction_epoch < ?
+        """, conn, params=(_epoch(date_from), _epoch(date_to)))
+    finally:
+        conn.close()
+    return compute_points(_backfill_rules, transactions)
+
+def _apply_backfill_chunk(conn, priced):
+    """Rewrite the ledger rows of a priced chunk and move balances by the point difference (not committed)"""
+    cursor = conn.cursor()
+    priced = priced.astype(object).where(priced.notna(), None)
+    cursor.execute("DELETE FROM temp.loyalty_backfill")
+    cursor.executemany("""
+        INSERT INTO temp.loyalty_backfill
+        (transaction_id, customer_id, total_amount, transaction_date, rule_name, points_earned, old_points)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, priced[['transaction_id', 'customer_id', 'total_amount', 'transaction_date', 'rule_name',
+                 'points_earned', 'old_points']].itertuples(index=False, name=None))
+    
+    cursor.execute("""
+        DELETE FROM loyalty_point_transactions
+        WHERE transaction_id IN (SELECT transaction_id FROM temp.loyalty_backfill WHERE rule_name IS NULL)
+    """)
+    cursor.execute("""
+        INSERT INTO loyalty_point_transactions
+        (transaction_id, customer_id, transaction_amount, points_earned, rule_applied, transaction_date)
+        SELECT transaction_id, customer_id, total_amount, points_earned, rule_name, transaction_date
+        FROM temp.loyalty_backfill
+        WHERE rule_name IS NOT NULL
+        ON CONFLICT(transaction_id) DO UPDATE SET
+            points_earned = excluded.points_earned,
+            rule_applied = excluded.rule_applied
+    """)
+    cursor.execute("""
+        UPDATE staging_customer_details
+        SET total_loyalty_points = total_loyalty_points + delta.points
+        FROM (
+            SELECT customer_id, SUM(COALESCE(points_earned, 0) - old_points) AS points
+            FROM temp.loyalty_backfill
+            GROUP BY customer_id
+        ) delta
+        WHERE staging_customer_details.customer_id = delta.customer_id AND delta.points != 0
+    """)
+    changed = cursor.execute("""
+        SELECT COUNT(*), COALESCE(SUM(COALESCE(points_earned, 0) - old_points), 0)
+        FROM temp.loyalty_backfill
+        WHERE COALESCE(points_earned, 0) != old_points
+    """).fetchone()
+    return changed
+
+def backfill_loyalty_points(db_path, rules=None, date_from=None, date_to=None,
+                            chunk_days=DEFAULT_BACKFILL_CHUNK_DAYS, workers=None, conn=None):
+    """Recompute accrued points under a rule set (default: the live rule table), returns (changed, delta)
+    
+    Transactions folded by a ledger compaction keep their compacted points.
+    """
+    db_path = db_path or get_db_path()
+    with connection_scope(db_path, conn) as conn:
+        create_indexes(conn, ['staging_store_sales_header', 'loyalty_point_transactions'])
+        rules = rules if rules is not None else load_loyalty_rules(conn)
+        bounds = conn.execute("""
+            SELECT MIN(transaction_date), MAX(transaction_date)
+            FROM staging_store_sales_header WHERE processed = 1
+        """).fetchone()
+        compacted_through = conn.execute(
+            "SELECT MAX(compacted_through) FROM loyalty_ledger_compactions"
+        ).fetchone()[0]
+        date_from = date_from or bounds[0]
+        date_to = date_to or bounds[1]
+        if compacted_through is not None and date_from is not None and date_from <= compacted_through:
+            date_from = (pd.Timestamp(compacted_through) + pd.Timedelta(seconds=1)).strftime('%Y-%m-%d %H:%M:%S')
+        if date_from is None or date_to is None or date_from > date_to:
+            print("[WARN] No accrued transactions to backfill")
+            return 0, 0
+        chunks = _date_chunks(date_from, date_to, chunk_days)
+        
+        conn.execute("DROP TABLE IF EXISTS temp.loyalty_backfill")
+        conn.execute("""
+            CREATE TEMP TABLE loyalty_backfill (
+                transaction_id TEXT PRIMARY KEY,
+                customer_id TEXT,
+                total_amount REAL,
+                transaction_date TEXT,
+                rule_name TEXT,
+                points_earned INTEGER,
+                old_points INTEGER
+            )
+        """)
+        
+        # Chunks price disjoint date ranges, so workers reading the committed ledger see
+        # exactly the old points of their own chunk while the parent's writes are pending
+        changed, delta = 0, 0
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_backfill_worker,
+                                     initargs=(compile_rules(rules),)) as pool:
+                futures = {pool.submit(_price_date_range, db_path, start, end): (start, end) for start, end in chunks}
+                for future in as_completed(futures):
+                    chunk_changed, chunk_delta = _apply_backfill_chunk(conn, future.result())
+                    changed += chunk_changed
+                    delta += chunk_delta
+                    start, end = futures[future]
+                    print(f"  [CHUNK {start[:10]}..{end[:10]}] {chunk_changed} transactions repriced "
+                          f"({chunk_delta:+,} points)")
+            
+            # Snapshots inside the backfilled range no longer hold; rebuild the newest one
+            conn.execute("DELETE FROM loyalty_balance_snapshots WHERE snapshot_date >= ?", (chunks[0][0],))
+            snapshot_balances(db_path, conn=conn)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute("DROP TABLE IF EXISTS temp.loyalty_backfill")
+    
+    print(f"[OK] Backfilled {changed} transactions across {len(chunks)} date chunks ({delta:+,} points)")
+    return changed, delta
@@ -1,128 +1,405 @@
 """Use Case 4: Customer Segmentation for Targeted Offers"""
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import date
 import sys
 import os
+import numpy as np
+import pandas as pd
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from common.database import get_connection
+from common.database import (
+    get_connection, connection_scope, get_watermark, set_watermark, day_key, create_indexes,
+)
+from usecase4.quantile_sketch import spend_threshold
 
-def calculate_rfm_metrics(db_path):
-    """Calculate RFM metrics and segment customers"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
+DEFAULT_RFM_BATCH_SIZE = 500000
+
+# Customers without a parseable purchase date
+UNKNOWN_RECENCY_DAYS = 999
+
+# Tables whose full reload invalidates the running purchase totals and stored segments
+TOTALS_SOURCES = ['staging_store_sales_header', 'staging_customer_details']
+
+# High-Spenders: top 10% by monetary value; At-Risk: 60+ days since the last purchase
+# but holding points; Regular: everyone else
+SEGMENTS = ['High-Spenders', 'At-Risk', 'Regular']
+AT_RISK_DAYS = 60
+
+# Score -> customer_segments column its quintile boundaries are read from
+SCORE_COLUMNS = {'r_score': 'last_purchase_day', 'f_score': 'frequency', 'm_score': 'monetary_value'}
+
+def reference_day(cursor):
+    """Day key recency is measured from: the newest transaction day, today without one"""
+    cursor.execute("SELECT MAX(transaction_day) FROM staging_store_sales_header")
+    max_day = cursor.fetchone()[0]
+    return day_key(date.today()) if max_day is None else max_day
+
+def recency_days(last_purchase_day, max_day):
+    """Days from each last purchase day key to max_day, plain integer arithmetic"""
+    days = max_day - pd.to_numeric(last_purchase_day, errors='coerce')
+    return days.fillna(UNKNOWN_RECENCY_DAYS).to_numpy(dtype=np.int64)
+
+def quintile_positions(n):
+    """Ascending positions of the four quintile boundaries among n values"""
+    return [max(n * k // 5 - 1, 0) for k in range(1, 5)]
+
+def quintile_boundaries(values):
+    """The four quintile boundaries of values: the value ranked just below each k/5 of them"""
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return np.empty(0)
+    positions = quintile_positions(len(values))
+    return np.partition(values, positions)[positions]
+
+def boundary_scores(values, boundaries):
+    """1-5 score of each value: one more per boundary it is strictly above"""
+    return 1 + np.searchsorted(boundaries, np.asarray(values, dtype=float), side='left')
+
+def quintile_scores(values, higher_is_better=True):
+    """1-5 quintile score from each value's min-rank (tied values share a score)
+
+    A value scores one more per quintile boundary it clears: the boundary k is
+    cleared when at least k/5 of all values are strictly worse, i.e. when the
+    value ranked just below that boundary (found with one np.partition) is worse.
+    """
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return np.empty(0, dtype=np.int64)
+    if not higher_is_better:
+        values = -values
+    return boundary_scores(values, quintile_boundaries(values))
+
+def score_customers(metrics, top_10_percent_threshold=None, boundaries=None):
+    """Add R/F/M quintile scores and the segment to a frame of customer metrics
+
+    top_10_percent_threshold (e.g. from a spend sketch) and boundaries (score ->
+    its four quintile boundaries, recency negated), when given, replace the ones
+    of the frame itself, so part of the customers can be scored against the
+    whole population.
+    """
+    monetary = metrics['monetary_value'].to_numpy(dtype=float)
     
-    # Clear previous segments
-    cursor.execute("DELETE FROM customer_segments")
+    # Top 10% threshold: the value ranked at the 10% position, as in a descending sort
+    if top_10_percent_threshold is None:
+        if len(monetary):
+            kth = len(monetary) - 1 - int(len(monetary) * 0.1)
+            top_10_percent_threshold = np.partition(monetary, kth)[kth]
+        else:
+            top_10_percent_threshold = 0
     
-    # Get current date (use max transaction date as reference)
-    cursor.execute("SELECT MAX(transaction_date) FROM staging_store_sales_header")
-    max_date_str = cursor.fetchone()[0]
+    values = {
+        'r_score': -metrics['recency_days'].to_numpy(dtype=float),
+        'f_score': metrics['frequency'].to_numpy(dtype=float),
+        'm_score': monetary,
+    }
+    if boundaries is None:
+        boundaries = {score: quintile_boundaries(score_values) for score, score_values in values.items()}
+    for score, score_values in values.items():
+        metrics[score] = boundary_scores(score_values, boundaries[score])
+    segment = np.select(
+        [
+            monetary >= top_10_percent_threshold,
+            # At-Risk: Haven't shopped in 60+ days but have points
+            (metrics['recency_days'].to_numpy() >= AT_RISK_DAYS) & (metrics['loyalty_points'].to_numpy() > 0),
+        ],
+        [0, 1],
+        default=2,
+    )
+    metrics['segment_name'] = pd.Categorical.from_codes(segment, SEGMENTS)
+    return metrics
+
+def reset_totals_after_reload(conn):
+    """Empty the purchase totals and segments if a source table was reloaded since they were built"""
+    reloads = {table: get_watermark(conn, f'reload:{table}') for table in TOTALS_SOURCES}
+    if all(count <= get_watermark(conn, f'customer_totals:{table}') for table, count in reloads.items()):
+        return False
     
-    if max_date_str:
-        try:
-            max_date = datetime.strptime(max_date_str.split()[0], '%Y-%m-%d')
-        except:
-            max_date = datetime.now()
-    else:
-        max_date = datetime.now()
+    conn.execute("DELETE FROM customer_purchase_totals")
+    conn.execute("DELETE FROM customer_segments")
+    conn.execute("DELETE FROM customer_score_boundaries")
+    conn.execute("UPDATE staging_store_sales_header SET aggregated = 0 WHERE aggregated != 0")
+    for table, count in reloads.items():
+        set_watermark(conn, f'customer_totals:{table}', count)
+    return True
+
+def update_customer_totals(conn):
+    """Fold transactions not aggregated yet into customer_purchase_totals, returns transactions folded
+
+    The customers folded are remembered in customer_segment_changes until their
+    segments are refreshed.
+    """
+    cursor = conn.cursor()
+    if reset_totals_after_reload(conn):
+        print("[OK] Sales or customers were reloaded, rebuilding customer totals")
     
-    # Calculate RFM metrics for each customer
+    # New transactions are found through the partial index on aggregated = 0
     cursor.execute("""
-        SELECT 
-            c.customer_id,
-            c.total_loyalty_points,
-            COALESCE(MAX(h.transaction_date), c.last_purchase_date) as last_purchase,
-            COUNT(DISTINCT h.transaction_id) as frequency,
-            COALESCE(SUM(h.total_amount), 0) as monetary_value
+        INSERT INTO customer_purchase_totals
+        (customer_id, last_purchase_date, last_purchase_day, transaction_count, total_spend)
+        SELECT customer_id, MAX(transaction_date), MAX(transaction_day), COUNT(*), SUM(total_amount)
+        FROM staging_store_sales_header
+        WHERE aggregated = 0
+        GROUP BY customer_id
+        ON CONFLICT(customer_id) DO UPDATE SET
+            last_purchase_date = MAX(COALESCE(last_purchase_date, ''), excluded.last_purchase_date),
+            last_purchase_day = COALESCE(MAX(last_purchase_day, excluded.last_purchase_day),
+                                         last_purchase_day, excluded.last_purchase_day),
+            transaction_count = transaction_count + excluded.transaction_count,
+            total_spend = total_spend + excluded.total_spend
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO customer_segment_changes (customer_id)
+        SELECT DISTINCT customer_id FROM staging_store_sales_header
+        WHERE aggregated = 0 AND customer_id IS NOT NULL
+    """)
+    cursor.execute("UPDATE staging_store_sales_header SET aggregated = 1 WHERE aggregated = 0")
+    folded = cursor.rowcount
+    conn.commit()
+    return folded
+
+def refresh_customer_metrics(cursor, max_day):
+    """Copy the metrics of changed, new and re-pointed customers into customer_segments
+
+    Changed customers are the ones whose purchase totals moved; new ones have no
+    segment row yet and re-pointed ones hold a different loyalty balance. Only
+    their rows are read. Returns customers whose metrics changed.
+    """
+    cursor.execute("""
+        INSERT OR IGNORE INTO customer_segment_changes (customer_id)
+        SELECT c.customer_id
         FROM staging_customer_details c
-        LEFT JOIN staging_store_sales_header h ON c.customer_id = h.customer_id
-        GROUP BY c.customer_id, c.total_loyalty_points, c.last_purchase_date
+        LEFT JOIN customer_segments s ON s.customer_id = c.customer_id
+        WHERE s.customer_id IS NULL OR s.loyalty_points IS NOT COALESCE(c.total_loyalty_points, 0)
     """)
+    cursor.execute("""
+        INSERT INTO customer_segments
+        (customer_id, recency_days, frequency, monetary_value, loyalty_points, last_purchase_day)
+        SELECT
+            c.customer_id,
+            COALESCE(? - COALESCE(t.last_purchase_day, c.last_purchase_day), ?),
+            COALESCE(t.transaction_count, 0),
+            COALESCE(t.total_spend, 0),
+            COALESCE(c.total_loyalty_points, 0),
+            COALESCE(t.last_purchase_day, c.last_purchase_day)
+        FROM customer_segment_changes ch
+        JOIN staging_customer_details c ON c.customer_id = ch.customer_id
+        LEFT JOIN customer_purchase_totals t ON t.customer_id = c.customer_id
+        WHERE true
+        ON CONFLICT(customer_id) DO UPDATE SET
+            recency_days = excluded.recency_days,
+            frequency = excluded.frequency,
+            monetary_value = excluded.monetary_value,
+            loyalty_points = excluded.loyalty_points,
+            last_purchase_day = excluded.last_purchase_day,
+            segment_date = CURRENT_TIMESTAMP
+        WHERE frequency IS NOT excluded.frequency
+           OR monetary_value IS NOT excluded.monetary_value
+           OR loyalty_points IS NOT excluded.loyalty_points
+           OR last_purchase_day IS NOT excluded.last_purchase_day
+    """, (max_day, UNKNOWN_RECENCY_DAYS))
+    return cursor.rowcount
+
+def _nth_value(cursor, column, position):
+    """Value at an ascending position of a customer_segments column, read from its index"""
+    return cursor.execute(
+        f"SELECT {column} FROM customer_segments WHERE {column} IS NOT NULL ORDER BY {column} LIMIT 1 OFFSET ?",
+        (position,),
+    ).fetchone()[0]
+
+def _nth_purchase_day(cursor, position, unknown_day):
+    """Purchase day key at an ascending position, customers without one counted at unknown_day"""
+    unknown = cursor.execute(
+        "SELECT COUNT(*) FROM customer_segments WHERE last_purchase_day IS NULL"
+    ).fetchone()[0]
+    earlier = cursor.execute(
+        "SELECT COUNT(*) FROM customer_segments WHERE last_purchase_day < ?", (unknown_day,)
+    ).fetchone()[0]
+    if position < earlier:
+        return _nth_value(cursor, 'last_purchase_day', position)
+    if position < earlier + unknown:
+        return unknown_day
+    return _nth_value(cursor, 'last_purchase_day', position - unknown)
+
+def population_boundaries(cursor, max_day):
+    """Quintile boundaries of every stored customer, the exact High-Spenders cut-off and the customer count
+
+    Values are read by position from the customer_segments indexes. The r_score
+    boundaries are purchase day keys (no purchase counts as UNKNOWN_RECENCY_DAYS
+    before max_day), so they stay put as days pass.
+    """
+    n = cursor.execute("SELECT COUNT(*) FROM customer_segments").fetchone()[0]
+    if not n:
+        return {score: [] for score in SCORE_COLUMNS}, 0, 0
     
-    customers = cursor.fetchall()
-    
-    # Calculate recency for each customer
-    customer_data = []
-    for cust_id, loyalty_points, last_purchase, frequency, monetary in customers:
-        if last_purchase:
-            try:
-                last_purchase_date = datetime.strptime(last_purchase.split()[0], '%Y-%m-%d')
-                recency_days = (max_date - last_purchase_date).days
-            except:
-                recency_days = 999
-        else:
-            recency_days = 999
-        
-        customer_data.append({
-            'customer_id': cust_id,
-            'recency_days': recency_days,
-            'frequency': frequency or 0,
-            'monetary_value': monetary or 0,
-            'loyalty_points': loyalty_points or 0
-        })
-    
-    # Calculate percentiles for segmentation
-    monetary_values = [c['monetary_value'] for c in customer_data]
-    monetary_values.sort(reverse=True)
+    positions = quintile_positions(n)
+    boundaries = {
+        score: [_nth_value(cursor, column, position) for position in positions]
+        for score, column in SCORE_COLUMNS.items() if score != 'r_score'
+    }
+    unknown_day = max_day - UNKNOWN_RECENCY_DAYS
+    boundaries['r_score'] = [_nth_purchase_day(cursor, position, unknown_day) for position in positions]
+    threshold = _nth_value(cursor, 'monetary_value', n - 1 - int(n * 0.1))
+    return boundaries, threshold, n
+
+def load_boundaries(cursor):
+    """Population state the stored scores were assigned against (score -> values by position)"""
+    boundaries = {}
+    for score, boundary in cursor.execute(
+        "SELECT score, boundary FROM customer_score_boundaries ORDER BY score, position"
+    ):
+        boundaries.setdefault(score, []).append(boundary)
+    return boundaries
+
+def save_boundaries(cursor, boundaries):
+    """Replace the stored population state"""
+    cursor.execute("DELETE FROM customer_score_boundaries")
+    cursor.executemany(
+        "INSERT INTO customer_score_boundaries (score, position, boundary) VALUES (?, ?, ?)",
+        [(score, position, value) for score, values in boundaries.items() for position, value in enumerate(values)],
+    )
+
+def rescore_filter(previous, current):
+    """SQL predicate (and parameters) on customer_segments of the customers a move of the
+    population state can rescore; everyone when there is no comparable previous state
+    """
+    if set(previous) != set(current) or any(len(previous[key]) != len(current[key]) for key in current):
+        return "1", []
     
-    if monetary_values:
-        top_10_percent_threshold = monetary_values[int(len(monetary_values) * 0.1)]
-    else:
-        top_10_percent_threshold = 0
+    clauses, params = [], []
+    unknown_day = current['reference_day'][0] - UNKNOWN_RECENCY_DAYS
+    for score, column in SCORE_COLUMNS.items():
+        for old, new in zip(previous[score], current[score]):
+            if old == new:
+                continue
+            # A boundary scores the values strictly above it
+            low, high = min(old, new), max(old, new)
+            clauses.append(f"({column} > ? AND {column} <= ?)")
+            params += [low, high]
+            if score == 'r_score' and low < unknown_day <= high:
+                clauses.append("last_purchase_day IS NULL")
+    old, new = previous['high_spender'][0], current['high_spender'][0]
+    if old != new:
+        clauses.append("(monetary_value >= ? AND monetary_value < ?)")
+        params += [min(old, new), max(old, new)]
+    old, new = previous['reference_day'][0], current['reference_day'][0]
+    if old != new:
+        # The At-Risk cut-off day and the stand-in day of customers without purchases moved
+        clauses.append("(last_purchase_day > ? AND last_purchase_day <= ?) OR last_purchase_day IS NULL")
+        params += [min(old, new) - AT_RISK_DAYS, max(old, new) - AT_RISK_DAYS]
+    return " OR ".join(clauses) or "0", params
+
+def changed_segments(metrics):
+    """Rows whose segment or scores differ from the stored segment row"""
+    changed = metrics['stored_segment_name'].isna().to_numpy(copy=True)
+    changed |= metrics['segment_name'].astype(object).to_numpy() != metrics['stored_segment_name'].to_numpy()
+    for score in SCORE_COLUMNS:
+        changed |= metrics[score].to_numpy() != metrics[f'stored_{score}'].to_numpy()
+    return metrics[changed]
+
+def rescore_customers(conn, predicate, params, max_day, boundaries, threshold, batch_size=DEFAULT_RFM_BATCH_SIZE):
+    """Score the changed customers and those matching predicate against the population, batch by batch
+
+    Only rows whose segment or scores change are written. Returns (customers
+    scored, segment rows written).
+    """
+    cursor = conn.cursor()
+    cursor.execute("DROP TABLE IF EXISTS temp.rescored_customers")
+    cursor.execute(f"""
+        CREATE TEMP TABLE rescored_customers AS
+        SELECT customer_id FROM customer_segments
+        WHERE customer_id IN (SELECT customer_id FROM customer_segment_changes) OR {predicate}
+    """, params)
     
-    # Segment customers
-    for customer in customer_data:
-        segment_name = None
-        
-        # High-Spenders: Top 10% by monetary value
-        if customer['monetary_value'] >= top_10_percent_threshold:
-            segment_name = 'High-Spenders'
-        
-        # At-Risk: Haven't shopped in 60+ days but have points
-        elif customer['recency_days'] >= 60 and customer['loyalty_points'] > 0:
-            segment_name = 'At-Risk'
+    # Recency boundaries are purchase day keys; scores compare negated recency
+    score_boundaries = {**boundaries, 'r_score': np.asarray(boundaries['r_score'], dtype=float) - max_day}
+    scored = written = 0
+    last_position = 0
+    while True:
+        batch = pd.read_sql("""
+            SELECT
+                r.rowid as position,
+                s.customer_id,
+                s.loyalty_points,
+                s.last_purchase_day,
+                s.frequency,
+                s.monetary_value,
+                s.segment_name as stored_segment_name,
+                s.r_score as stored_r_score,
+                s.f_score as stored_f_score,
+                s.m_score as stored_m_score
+            FROM temp.rescored_customers r
+            JOIN customer_segments s ON s.customer_id = r.customer_id
+            WHERE r.rowid > ?
+            ORDER BY r.rowid
+            LIMIT ?
+        """, conn, params=(last_position, batch_size))
+        if batch.empty:
+            break
+        last_position = int(batch['position'].iloc[-1])
+        batch['recency_days'] = recency_days(batch['last_purchase_day'], max_day)
+        changed = changed_segments(score_customers(batch, threshold, score_boundaries))
         
-        # Regular customers (others)
-        else:
-            segment_name = 'Regular'
-        
-        # Insert segment
-        cursor.execute("""
-            INSERT INTO customer_segments
-            (customer_id, segment_name, recency_days, frequency, monetary_value, loyalty_points)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (
-            customer['customer_id'],
-            segment_name,
-            customer['recency_days'],
-            customer['frequency'],
-            customer['monetary_value'],
-            customer['loyalty_points']
+        cursor.executemany("""
+            UPDATE customer_segments
+            SET segment_name = ?, recency_days = ?, r_score = ?, f_score = ?, m_score = ?,
+                segment_date = CURRENT_TIMESTAMP
+            WHERE customer_id = ?
+        """, zip(
+            changed['segment_name'].tolist(),
+            changed['recency_days'].tolist(),
+            changed['r_score'].tolist(),
+            changed['f_score'].tolist(),
+            changed['m_score'].tolist(),
+            changed['customer_id'].tolist(),
         ))
-    
-    # Update customer_details with segment_id
-    cursor.execute("""
-        UPDATE staging_customer_details
-        SET segment_id = (
-            SELECT segment_name
-            FROM customer_segments
-            WHERE customer_segments.customer_id = staging_customer_details.customer_id
+        # Update customer_details with segment_id, for changed customers only
+        cursor.executemany(
+            "UPDATE staging_customer_details SET segment_id = ? WHERE customer_id = ?",
+            zip(changed['segment_name'].tolist(), changed['customer_id'].tolist()),
         )
-    """)
-    
-    # Get segment statistics
-    cursor.execute("""
-        SELECT segment_name, COUNT(*) as count
-        FROM customer_segments
-        GROUP BY segment_name
-        ORDER BY count DESC
-    """)
+        scored += len(batch)
+        written += len(changed)
     
-    segments = cursor.fetchall()
-    
-    conn.commit()
-    conn.close()
+    cursor.execute("DROP TABLE IF EXISTS temp.rescored_customers")
+    return scored, written
+
+def calculate_rfm_metrics(db_path, sketch_error=None, workers=None, conn=None):
+    """Calculate RFM metrics and segment customers, rescoring only customers that can have changed
+
+    Those are customers whose totals or points changed, plus customers between
+    the old and new position of a quintile boundary, the High-Spenders cut-off
+    or the At-Risk day; they are scored in batches of DEFAULT_RFM_BATCH_SIZE.
+    With sketch_error the cut-off comes from a quantile sketch of every
+    customer's spend (rank error about sketch_error), fed from rowid ranges of
+    customer_purchase_totals by `workers` processes, instead of an exact
+    selection.
+    """
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        folded = update_customer_totals(conn)
+        create_indexes(conn, ['customer_segments'])
+        
+        max_day = reference_day(cursor)
+        refreshed = refresh_customer_metrics(cursor, max_day)
+        boundaries, threshold, customers = population_boundaries(cursor, max_day)
+        if sketch_error and customers:
+            threshold = spend_threshold(db_path, 10, error=sketch_error, workers=workers, conn=conn)
+        current = {**boundaries, 'high_spender': [threshold], 'reference_day': [max_day]}
+        predicate, params = rescore_filter(load_boundaries(cursor), current)
+        scored, written = rescore_customers(conn, predicate, params, max_day, boundaries, threshold)
+        
+        save_boundaries(cursor, current)
+        cursor.execute("DELETE FROM customer_segment_changes")
+        conn.commit()
+        
+        # Segment statistics
+        counts = cursor.execute("""
+            SELECT segment_name, COUNT(*) FROM customer_segments
+            WHERE segment_name IS NOT NULL GROUP BY segment_name
+        """).fetchall()
+    segments = sorted(counts, key=lambda row: (-row[1], SEGMENTS.index(row[0])))
     
+    print(f"[OK] Folded {folded} new transactions into customer totals, {refreshed} customers' metrics changed")
+    print(f"[OK] Rescored {scored} of {customers} customers, {written} segment rows changed")
     print("[OK] Customer segmentation complete")
     print("\nCustomer Segments:")
     print("-" * 40)
@@ -131,13 +408,13 @@ def calculate_rfm_metrics(db_path):
     
     return segments
 
-def execute(db_path):
+def execute(db_path, sketch_error=None, workers=None, conn=None):
     """Execute Use Case 4 pipeline"""
     print("\n" + "="*60)
     print("USE CASE 4: CUSTOMER SEGMENTATION FOR TARGETED OFFERS")
     print("="*60)
     
-    segments = calculate_rfm_metrics(db_path)
+    segments = calculate_rfm_metrics(db_path, sketch_error=sketch_error, workers=workers, conn=conn)
     print("\n[OK] Use Case 4 completed successfully")
     return segments
 
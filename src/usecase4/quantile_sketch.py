@@ -0,0 +1,190 @@
+"""Mergeable quantile sketch for customer spend thresholds (Use Case 4)
+
+A KLL sketch: level h holds items that each stand for 2**h values. When a
+level outgrows its capacity it is sorted and every other item (odd or even
+positions, picked at random) moves up a level with doubled weight. Capacities
+shrink geometrically (factor 2/3) below the top level, so memory stays
+O(k log(n / k)) however many values are added, and two sketches merge by
+concatenating their levels and compacting again, which is what lets workers
+sketch disjoint customer ranges in parallel.
+
+The rank error of a quantile is about SKETCH_CONSTANT / k of n (with high
+probability), so k is derived from the requested error.
+"""
+import os
+import sys
+import math
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.database import connection_scope, get_db_path
+
+DEFAULT_SKETCH_ERROR = 0.01
+DEFAULT_SKETCH_CHUNK_SIZE = 100000
+SKETCH_CONSTANT = 2.0
+CAPACITY_DECAY = 2 / 3
+
+def new_sketch(error=DEFAULT_SKETCH_ERROR, seed=0):
+    """Empty sketch whose quantiles are off by about error * n in rank"""
+    k = max(8, math.ceil(SKETCH_CONSTANT / error))
+    return {'k': k, 'n': 0, 'levels': [np.empty(0)], 'rng': np.random.default_rng(seed)}
+
+def _capacity(k, height, level):
+    """Items level may hold in a sketch with height levels"""
+    return max(2, math.ceil(k * CAPACITY_DECAY ** (height - 1 - level)))
+
+def _compact(sketch):
+    """Compact levels until each fits its capacity"""
+    levels, k, rng = sketch['levels'], sketch['k'], sketch['rng']
+    compacted = True
+    while compacted:
+        compacted = False
+        for level in range(len(levels)):
+            if len(levels[level]) <= _capacity(k, len(levels), level):
+                continue
+            items = np.sort(levels[level])
+            even = len(items) - len(items) % 2
+            if level + 1 == len(levels):
+                levels.append(np.empty(0))
+            levels[level + 1] = np.concatenate((levels[level + 1], items[rng.integers(2):even:2]))
+            levels[level] = items[even:]
+            compacted = True
+
+def sketch_update(sketch, values):
+    """Add a batch of values (NaN ignored)"""
+    values = np.asarray(values, dtype=float)
+    values = values[~np.isnan(values)]
+    sketch['levels'][0] = np.concatenate((sketch['levels'][0], values))
+    sketch['n'] += len(values)
+    _compact(sketch)
+    return sketch
+
+def merge_sketches(sketch, other):
+    """Fold another sketch (same error) into sketch"""
+    levels = sketch['levels']
+    for level, items in enumerate(other['levels']):
+        if level == len(levels):
+            levels.append(np.empty(0))
+        levels[level] = np.concatenate((levels[level], items))
+    sketch['n'] += other['n']
+    _compact(sketch)
+    return sketch
+
+def sketch_size(sketch):
+    """Items the sketch holds"""
+    return sum(len(items) for items in sketch['levels'])
+
+def sketch_quantile(sketch, q):
+    """Value at quantile q (scalar or array) of everything added"""
+    items = np.concatenate(sketch['levels'])
+    if not len(items):
+        return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+    weights = np.concatenate([np.full(len(level), 2.0 ** height) for height, level in enumerate(sketch['levels'])])
+    order = np.argsort(items, kind='stable')
+    cumulative = np.cumsum(weights[order])
+    position = np.searchsorted(cumulative, np.asarray(q) * cumulative[-1], side='left')
+    return items[order][np.minimum(position, len(items) - 1)]
+
+def top_percent_quantile(n, percent):
+    """Quantile of the value ranked at the top-percent position of a descending sort of n values"""
+    return (n - 1 - int(n * percent / 100)) / max(n - 1, 1) if n else 0.0
+
+def _spend_chunks(conn, chunksize, rowid_from=None, rowid_to=None):
+    """Spend of the customers holding purchase totals, chunk by chunk (a rowid range of them if given)"""
+    query = """
+        SELECT COALESCE(t.total_spend, 0) as monetary_value
+        FROM customer_purchase_totals t
+        WHERE t.customer_id IN (SELECT customer_id FROM staging_customer_details)
+    """
+    params = ()
+    if rowid_from is not None:
+        query += " AND t.rowid >= ? AND t.rowid < ?"
+        params = (rowid_from, rowid_to)
+    for chunk in pd.read_sql(query, conn, params=params, chunksize=chunksize):
+        yield chunk['monetary_value'].to_numpy(dtype=float)
+
+def _customers_without_purchases(conn):
+    """Customers without purchase totals, each with a monetary value of 0"""
+    return conn.execute("""
+        SELECT COUNT(*) FROM staging_customer_details c
+        WHERE NOT EXISTS (SELECT 1 FROM customer_purchase_totals t WHERE t.customer_id = c.customer_id)
+    """).fetchone()[0]
+
+def _zero_chunks(count, chunksize):
+    """count zeros, chunk by chunk"""
+    for start in range(0, count, chunksize):
+        yield np.zeros(min(chunksize, count - start))
+
+def _sketch_rowid_range(db_path, rowid_from, rowid_to, error, seed, chunksize):
+    """Worker: sketch the spend in a customer_purchase_totals rowid range through its own connection"""
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+    try:
+        sketch = new_sketch(error, seed)
+        for values in _spend_chunks(conn, chunksize, rowid_from, rowid_to):
+            sketch_update(sketch, values)
+    finally:
+        conn.close()
+    return sketch
+
+def sketch_customer_spend(db_path, error=DEFAULT_SKETCH_ERROR, workers=None, chunksize=DEFAULT_SKETCH_CHUNK_SIZE,
+                          conn=None):
+    """Sketch every customer's monetary value, in parallel rowid ranges of customer_purchase_totals when workers > 1
+
+    Customers without purchases are added as zeros; the workers read committed totals.
+    """
+    db_path = db_path or get_db_path()
+    with connection_scope(db_path, conn) as conn:
+        zeros = _customers_without_purchases(conn)
+        if not workers or workers <= 1:
+            sketch = new_sketch(error)
+            for values in _spend_chunks(conn, chunksize):
+                sketch_update(sketch, values)
+        else:
+            low, high = conn.execute("SELECT MIN(rowid), MAX(rowid) FROM customer_purchase_totals").fetchone()
+            sketch = new_sketch(error)
+            if low is not None:
+                bounds = np.linspace(low, high + 1, workers + 1).astype(np.int64)
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    sketches = pool.map(_sketch_rowid_range, [db_path] * workers, bounds[:-1].tolist(),
+                                        bounds[1:].tolist(), [error] * workers, range(workers), [chunksize] * workers)
+                    for other in sketches:
+                        merge_sketches(sketch, other)
+    
+    for values in _zero_chunks(zeros, chunksize):
+        sketch_update(sketch, values)
+    return sketch
+
+def spend_threshold(db_path, top_percent=10, error=DEFAULT_SKETCH_ERROR, workers=None, conn=None):
+    """Approximate spend cut-off of the top top_percent of customers"""
+    sketch = sketch_customer_spend(db_path, error=error, workers=workers, conn=conn)
+    return float(sketch_quantile(sketch, top_percent_quantile(sketch['n'], top_percent)))
+
+def check_sketch_error(db_path, error=DEFAULT_SKETCH_ERROR, workers=None, percents=(1, 5, 10, 25, 50), conn=None):
+    """Compare sketched top-N% spend thresholds with the exact ones, returns the report rows"""
+    sketch = sketch_customer_spend(db_path, error=error, workers=workers, conn=conn)
+    with connection_scope(db_path or get_db_path(), conn) as conn:
+        exact_values = np.sort(np.concatenate([
+            *_spend_chunks(conn, DEFAULT_SKETCH_CHUNK_SIZE), np.zeros(_customers_without_purchases(conn)),
+        ]))
+    
+    n = len(exact_values)
+    report = []
+    print(f"\nSpend sketch vs exact ({n} customers, {sketch_size(sketch)} items kept, target rank error {error:.2%}):")
+    print("-" * 80)
+    for percent in percents:
+        if not n:
+            break
+        exact = exact_values[n - 1 - int(n * percent / 100)]
+        approximate = float(sketch_quantile(sketch, top_percent_quantile(n, percent)))
+        # Rank error: how far the sketched value's rank range is from the exact position
+        low = np.searchsorted(exact_values, approximate, side='left')
+        high = np.searchsorted(exact_values, approximate, side='right') - 1
+        position = n - 1 - int(n * percent / 100)
+        rank_error = max(0, low - position, position - high) / n
+        report.append((percent, exact, approximate, rank_error))
+        print(f"  top {percent:>3}%: exact {exact:>12.2f}  sketch {approximate:>12.2f}  rank error {rank_error:.3%}")
+    status = "[OK]" if all(row[3] <= error for row in report) else "[WARN]"
+    print(f"{status} Largest rank error {max((row[3] for row in report), default=0):.3%} (target {error:.2%})")
+    return report
@@ -2,79 +2,92 @@
 import sqlite3
 import sys
 import os
+import textwrap
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from common.database import get_connection
+from common.database import get_connection, connection_scope, create_indexes
+from usecase3.loyalty_balances import COMPACTED_RULE
+from usecase5.notification_dispatcher import dispatch_notifications, DEFAULT_WORKERS
 
-def generate_notifications(db_path):
-    """Generate and send loyalty point notifications"""
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-    
-    # Clear previous notifications
-    cursor.execute("DELETE FROM loyalty_notifications")
-    
-    # Get customers with updated loyalty points (from recent transactions)
-    cursor.execute("""
-        SELECT DISTINCT
-            lpt.customer_id,
-            c.email,
-            c.first_name,
-            lpt.points_earned,
-            c.total_loyalty_points
-        FROM loyalty_point_transactions lpt
-        JOIN staging_customer_details c ON lpt.customer_id = c.customer_id
-        WHERE lpt.customer_id NOT IN (
-            SELECT customer_id FROM loyalty_notifications 
-            WHERE status = 'sent'
-        )
-    """)
-    
-    customers = cursor.fetchall()
-    
-    notifications_sent = 0
-    
-    for customer_id, email, first_name, points_earned, total_points in customers:
-        # Generate email content
-        subject = "Your Loyalty Points Update"
-        body = f"""
-Hi {first_name or 'Valued Customer'},
+DEFAULT_ENQUEUE_BATCH_SIZE = 10000
 
-Great news! You've earned {points_earned} loyalty points from your recent purchase!
+# Rendered once per outbox row at enqueue time
+NOTIFICATION_SUBJECT = "Your Loyalty Points Update"
+NOTIFICATION_BODY = textwrap.dedent("""
+    Hi {first_name},
 
-Your total loyalty points balance is now: {total_points} points
+    Great news! You've earned {points_earned} loyalty points from your recent purchase!
 
-Thank you for being a loyal customer!
+    Your total loyalty points balance is now: {total_points} points
 
-Best regards,
-Retail Team
-        """.strip()
+    Thank you for being a loyal customer!
+
+    Best regards,
+    Retail Team
+""").strip()
+
+def email_domain(email):
+    """Lower-cased domain of an address, the unit of per-domain rate limits"""
+    return email.rsplit('@', 1)[-1].strip().lower()
+
+def generate_notifications(db_path, batch_size=DEFAULT_ENQUEUE_BATCH_SIZE, conn=None):
+    """Queue a pending notification for every ledger transaction not in the outbox yet"""
+    with connection_scope(db_path, conn) as conn:
+        cursor = conn.cursor()
+        create_indexes(conn, ['loyalty_notifications'])
         
-        # Insert notification
+        # New ledger rows are found through the outbox's transaction_id index;
+        # compacted ledger rows fold history and are never announced
         cursor.execute("""
-            INSERT INTO loyalty_notifications
-            (customer_id, email, subject, body, points_earned, total_points, status)
-            VALUES (?, ?, ?, ?, ?, ?, 'sent')
-        """, (customer_id, email, subject, body, points_earned, total_points))
+            SELECT
+                lpt.transaction_id,
+                lpt.customer_id,
+                c.email,
+                c.first_name,
+                lpt.points_earned,
+                c.total_loyalty_points
+            FROM loyalty_point_transactions lpt
+            JOIN staging_customer_details c ON lpt.customer_id = c.customer_id
+            WHERE c.email LIKE '%@%'
+            AND lpt.rule_applied IS NOT ?
+            AND NOT EXISTS (
+                SELECT 1 FROM loyalty_notifications n WHERE n.transaction_id = lpt.transaction_id
+            )
+            AND NOT EXISTS (
+                SELECT 1 FROM compacted_transactions ct WHERE ct.transaction_id = lpt.transaction_id
+            )
+        """, (COMPACTED_RULE,))
         
-        notifications_sent += 1
+        notifications_queued = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            conn.executemany("""
+                INSERT INTO loyalty_notifications
+                (transaction_id, customer_id, email, domain, subject, body, points_earned, total_points, status)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pending')
+            """, [
+                (transaction_id, customer_id, email, email_domain(email), NOTIFICATION_SUBJECT,
+                 NOTIFICATION_BODY.format(first_name=first_name or 'Valued Customer',
+                                          points_earned=points_earned, total_points=total_points),
+                 points_earned, total_points)
+                for transaction_id, customer_id, email, first_name, points_earned, total_points in rows
+            ])
+            notifications_queued += len(rows)
         
-        # In a real system, this would send the email
-        # For simulation, we just log it
-        print(f"[NOTIFICATION] Sent to {email}: Earned {points_earned} points, Total: {total_points}")
-    
-    conn.commit()
-    conn.close()
+        conn.commit()
     
-    print(f"\n[OK] Generated {notifications_sent} loyalty notifications")
-    return notifications_sent
+    print(f"[OK] Queued {notifications_queued} loyalty notifications in the outbox")
+    return notifications_queued
 
-def execute(db_path):
-    """Execute Use Case 5 pipeline"""
+def execute(db_path, sink=None, workers=DEFAULT_WORKERS, conn=None):
+    """Execute Use Case 5 pipeline: queue new notifications, then deliver the outbox"""
     print("\n" + "="*60)
     print("USE CASE 5: AUTOMATED LOYALTY NOTIFICATION SYSTEM")
     print("="*60)
     
-    count = generate_notifications(db_path)
+    generate_notifications(db_path, conn=conn)
+    count, _, _ = dispatch_notifications(db_path, sink=sink, workers=workers, conn=conn)
     print(f"\n[OK] Use Case 5 completed successfully - {count} notifications sent")
     return count
 
@@ -10,36 +10,32 @@ def normalize_1nf(db_path='retail_db.sqlite'):
     df = pd.read_sql("SELECT * FROM raw_store_sales_line_items", conn)
     
     # Find rows with comma-separated product_ids (1NF violation)
-    split_rows = []
-    rows_to_remove = []
+    product_ids = df['product_id'].astype('string').fillna('')
+    multi_mask = product_ids.str.contains(',', regex=False)
     
-    max_id = df['line_item_id'].max() if len(df) > 0 else 0
-    new_id = int(max_id) + 1
-    
-    for idx, row in df.iterrows():
-        product_id = str(row['product_id']) if pd.notna(row['product_id']) else ''
-        if ',' in product_id:
-            # Split into multiple rows
-            product_ids = [p.strip().strip('"') for p in product_id.split(',')]
-            for i, pid in enumerate(product_ids):
-                if pid:  # Only if not empty
-                    new_row = row.copy()
-                    new_row['line_item_id'] = new_id if i == 0 else new_id + i
-                    new_row['product_id'] = pid
-                    # Adjust line_item_amount proportionally
-                    new_row['line_item_amount'] = row['line_item_amount'] / len(product_ids)
-                    split_rows.append(new_row)
-            new_id += len(product_ids)
-            rows_to_remove.append(idx)
-    
-    if split_rows:
-        # Remove original rows with commas
-        df_clean = df.drop(rows_to_remove)
-        # Add split rows
-        split_df = pd.DataFrame(split_rows)
-        df_final = pd.concat([df_clean, split_df], ignore_index=True)
+    if multi_mask.any():
+        max_id = df['line_item_id'].max() if len(df) > 0 else 0
+        new_id = int(max_id) + 1
+        
+        # Explode all multi-value rows at once; every source row reserves one id per list entry
+        multi = df[multi_mask].copy()
+        multi['_parts'] = product_ids[multi_mask].str.split(',')
+        multi['_count'] = multi['_parts'].str.len()
+        multi['_base_id'] = new_id + multi['_count'].cumsum() - multi['_count']
+        
+        split_df = multi.explode('_parts')
+        split_df['_idx'] = split_df.groupby(level=0).cumcount()
+        split_df['product_id'] = split_df['_parts'].str.strip().str.strip('"')
+        split_df = split_df[split_df['product_id'] != '']
+        split_df['line_item_id'] = split_df['_base_id'] + split_df['_idx']
+        # Adjust line_item_amount proportionally
+        split_df['line_item_amount'] = split_df['line_item_amount'] / split_df['_count']
+        split_df = split_df[df.columns]
+        
+        # Remove original rows with commas and add split rows
+        df_final = pd.concat([df[~multi_mask], split_df], ignore_index=True)
         df_final.to_sql('raw_store_sales_line_items', conn, if_exists='replace', index=False)
-        print(f"[OK] 1NF: Split {len(split_rows)} multi-value product_id records")
+        print(f"[OK] 1NF: Split {len(split_df)} multi-value product_id records")
     
     conn.commit()
     conn.close()